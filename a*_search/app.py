@@ -1,124 +1,1160 @@
-from heapq import heappush, heappop
-from collections import defaultdict
-from haversine import haversine, Unit
+from heapq import heappush, heappop, heapreplace
+from haversine import haversine_vector, Unit
 
+from contextlib import contextmanager, nullcontext
+from itertools import accumulate
+from array import array
+
+import multiprocessing
+import random
+import time
+import numpy as np
+import argparse
+import csv
+import hashlib
+import json
+import mmap
+import struct
 import sys
+import os
 import re
 
-class TreeNode():
-    def __init__(self, city, long=None, lat=None, state=None, cost=0.0, parent=None):
-        self.cost = cost
-        self.state = state
-        self.city = city
-        self.parent = parent
-        self.long = long
+GRAPH_CACHE_MAGIC = b'RGRAPH\x00\x00'
+GRAPH_CACHE_VERSION = 2
+# magic, format version, section count, source mtime (ns), source size, source sha256
+CACHE_HEADER = struct.Struct('<8sIIqq32s')
+# section name, numpy dtype string, byte offset, element count
+CACHE_SECTION = struct.Struct('<16s4sxxxxqq')
+
+class RoadGraph():
+    '''
+    Road network with every city interned to an integer id. Coordinates are kept in parallel arrays
+    and the adjacency is stored CSR-style: the neighbors of city i are neighbors[offsets[i]:offsets[i + 1]]
+    and weights holds the matching road distances.
+    '''
+    def __init__(self, names, lat, lon, offsets, neighbors, weights):
+        self.names = names
+        self.city_id = {name: idx for idx, name in enumerate(names)}
         self.lat = lat
+        self.lon = lon
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.weights = weights
+        self.index = None
 
-    def __lt__(self, next_node):
-        return self.cost < next_node.cost
-    
-    def isGoal(self, goal_city):
-        return str(self.city) == goal_city
-class PriorityQueue:
-    
-    def __init__(self, iterable=None):
-        iterable = [] if iterable is None else iterable
-        self.heap = []
-        for value in iterable:
-            heappush(self.heap, (0, value))
-    
-    def add(self, value, priority=0):
-        heappush(self.heap, (priority, value))
-    
-    def pop(self):
-        priority, value = heappop(self.heap)
-        return value
-    
     def __len__(self):
-        return len(self.heap)
-    
-    def includes(self, condition_1):
-        return condition_1 in self.heap
-
-def restructure_path(node, start_city, reached_node, frontier):
-    '''
-    Trace back the most optimal path, get nodes in frontier and totai nodes generated
-    '''
-    solution_path = [node]
-    curr_city = node.city
-    while curr_city != start_city:
-        solution_path.insert(0, reached_node[curr_city])
-        curr_city = reached_node[curr_city].city
-    
-    route = ""
-    distance = 0.0
-    for cities in range(len(solution_path)):
-        route += solution_path[cities].city + " "
-        distance += solution_path[cities].cost
-    
-    sys.stdout.write(f'Route found: {route}\n')
-    sys.stdout.write(f'Distance: {distance} miles\n')
-    sys.stdout.write(f'Total nodes generated: {len(reached_node)}\n')
-    sys.stdout.write(f'Nodes left in frontier: {len(frontier)}\n')
-    
-def parse_city_distance(city_distances, node, sub_key):
-    '''
-    Parse a specific children city's distance by parent city's name
-    '''
-    curr_distance = city_distances.get(str(node), None)
-    for distance in curr_distance:
-        if sub_key in distance.keys():
-            return distance[sub_key]
-
-def calculate_optimal_path(start_state, start_point, destination_point, city_distance, city_location):
-    sys.stdout.write(f'Search for a path from {start_point} to {destination_point}...\n')
-    
-    node = TreeNode(
-        state=start_state, 
-        city=start_point,
-        long=city_location[start_point][1],
-        lat=city_location[start_point][0],
-        cost=0.0
-    )
-    visited = set()
-    frontier = PriorityQueue()
-    frontier.add(node)
-    reached = {}
-    cost = {node.city: 0}
+        return len(self.names)
+
+    def __contains__(self, city):
+        return city in self.city_id
+
+    @classmethod
+    def from_edges(cls, names, lat, lon, sources, targets, distances):
+        '''
+        Build the CSR arrays from an undirected edge list, storing every road in both directions
+        '''
+        city_count = len(names)
+        tail = np.concatenate((np.asarray(sources, dtype=np.int32), np.asarray(targets, dtype=np.int32)))
+        head = np.concatenate((np.asarray(targets, dtype=np.int32), np.asarray(sources, dtype=np.int32)))
+        length = np.concatenate((np.asarray(distances, dtype=np.float64), np.asarray(distances, dtype=np.float64)))
+
+        order = np.argsort(tail, kind='stable')
+        offsets = np.zeros(city_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tail, minlength=city_count), out=offsets[1:])
+        return cls(
+            names,
+            np.asarray(lat, dtype=np.float64),
+            np.asarray(lon, dtype=np.float64),
+            offsets,
+            head[order],
+            length[order]
+        )
+
+    def edges(self, city):
+        '''
+        Neighbor ids and road distances of a city as plain lists, ready for a tight search loop
+        '''
+        first, last = self.offsets[city], self.offsets[city + 1]
+        return self.neighbors[first:last].tolist(), self.weights[first:last].tolist()
+
+    def location(self, city):
+        return float(self.lat[city]), float(self.lon[city])
+
+    def spatial_index(self):
+        '''
+        The k-d tree over the city coordinates, built on first use and then kept for later queries
+        '''
+        if self.index is None:
+            self.index = CityIndex.build(self)
+        return self.index
+
+EARTH_RADIUS_MILES = 3958.8
+
+def unit_vectors(lat, lon):
+    '''
+    Cities as points on the unit sphere, where straight-line (chord) distance grows with great-circle
+    distance, so a k-d tree on them answers great-circle nearest-neighbor queries exactly
+    '''
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+class CityIndex():
+    '''
+    Implicit k-d tree over the city coordinates. order is a permutation of the city ids: the subtree over
+    order[low:high] has its splitting city at the middle position mid, split along axis[mid], with the
+    lower half to its left and the upper half to its right. Ranges of at most LEAF_SIZE cities are
+    scanned directly.
+    '''
+    LEAF_SIZE = 8
+
+    def __init__(self, graph, order, axis):
+        self.graph = graph
+        self.order = order
+        self.axis = axis
+        self.points = unit_vectors(graph.lat, graph.lon)
+
+    @classmethod
+    def build(cls, graph):
+        points = unit_vectors(graph.lat, graph.lon)
+        order = np.arange(len(graph), dtype=np.int32)
+        axis = np.zeros(len(graph), dtype=np.int8)
+        pending = [(0, len(graph))]
+        while pending:
+            low, high = pending.pop()
+            if high - low <= cls.LEAF_SIZE:
+                continue
+            mid = (low + high) // 2
+            block = points[order[low:high]]
+            split = int(np.argmax(block.max(axis=0) - block.min(axis=0)))
+            order[low:high] = order[low:high][np.argpartition(block[:, split], mid - low)]
+            axis[mid] = split
+            pending.append((low, mid))
+            pending.append((mid + 1, high))
+        return cls(graph, order, axis)
+
+    def _chord_search(self, point, visit, bound):
+        '''
+        Walk the tree depth-first, nearer side first. visit(city, squared chord) is called for every city
+        that may lie within sqrt(bound()) and may shrink that bound as it goes.
+        '''
+        pending = [(0, len(self.order))]
+        while pending:
+            low, high = pending.pop()
+            if high - low <= self.LEAF_SIZE:
+                for city in self.order[low:high].tolist():
+                    offset = self.points[city] - point
+                    visit(city, float(offset @ offset))
+                continue
+            mid = (low + high) // 2
+            city = int(self.order[mid])
+            split = self.axis[mid]
+            offset = self.points[city] - point
+            visit(city, float(offset @ offset))
+            gap = point[split] - self.points[city][split]
+            near, far = ((mid + 1, high), (low, mid)) if gap > 0 else ((low, mid), (mid + 1, high))
+            if gap * gap <= bound():
+                pending.append(far)
+            pending.append(near)
 
+    def nearest(self, lat, lon, count=1):
+        '''
+        The count cities closest to a coordinate, as (city id, great-circle miles), nearest first
+        '''
+        point = unit_vectors(lat, lon)[0]
+        best = []
+
+        def visit(city, chord):
+            if len(best) < count:
+                heappush(best, (-chord, city))
+            elif chord < -best[0][0]:
+                heapreplace(best, (-chord, city))
+
+        self._chord_search(point, visit, lambda: -best[0][0] if len(best) == count else float('inf'))
+        cities = [city for _, city in sorted(best, reverse=True)]
+        return list(zip(cities, self._miles(lat, lon, cities)))
+
+    def within(self, lat, lon, miles):
+        '''
+        All cities within a great-circle radius of a coordinate, as (city id, miles), nearest first
+        '''
+        point = unit_vectors(lat, lon)[0]
+        # Slightly generous chord bound; the exact haversine check below has the final say
+        chord = 2 * np.sin(min(miles / EARTH_RADIUS_MILES, np.pi) / 2) * 1.001
+        limit = chord * chord
+        candidates = []
+
+        def visit(city, chord):
+            if chord <= limit:
+                candidates.append(city)
+
+        self._chord_search(point, visit, lambda: limit)
+        found = [(city, distance) for city, distance in zip(candidates, self._miles(lat, lon, candidates))
+                 if distance <= miles]
+        return sorted(found, key=lambda entry: entry[1])
+
+    def _miles(self, lat, lon, cities):
+        if not cities:
+            return []
+        coordinates = np.column_stack((self.graph.lat[cities], self.graph.lon[cities]))
+        return haversine_vector(np.broadcast_to((lat, lon), coordinates.shape), coordinates, Unit.MILES).tolist()
+
+def heuristic_table(graph, goal, landmarks=None):
+    '''
+    Lower bound on the road distance from every city to the goal, computed in one vectorized pass per
+    query: the great-circle miles, tightened by the landmark bound when a LandmarkTable is given
+    '''
+    coordinates = np.column_stack((graph.lat, graph.lon))
+    goal_coordinates = np.broadcast_to(coordinates[goal], coordinates.shape)
+    remaining = haversine_vector(coordinates, goal_coordinates, Unit.MILES)
+    if landmarks is not None:
+        remaining = np.maximum(remaining, landmarks.lower_bounds(goal))
+    return remaining.tolist()
+
+def shortest_distances(graph, source):
+    '''
+    Plain Dijkstra from one city to every other; unreachable cities stay at infinity
+    '''
+    inf = float('inf')
+    cost = [inf] * len(graph)
+    cost[source] = 0.0
+    frontier = [(0.0, source)]
     while frontier:
-        node = frontier.pop()
+        city_cost, city = heappop(frontier)
+        if city_cost > cost[city]:
+            continue
+        neighbors, distances = graph.edges(city)
+        for child, input_distance in zip(neighbors, distances):
+            child_cost = city_cost + input_distance
+            if child_cost < cost[child]:
+                cost[child] = child_cost
+                heappush(frontier, (child_cost, child))
+    return np.array(cost)
+
+class LandmarkTable():
+    '''
+    ALT preprocessing: road distances between a few landmark cities and every city. Roads are undirected,
+    so by the triangle inequality |d(L, v) - d(L, t)| <= d(v, t) for every landmark L, and the largest of
+    these differences is an admissible, consistent heuristic towards t.
+    '''
+    def __init__(self, landmarks, distances):
+        self.landmarks = landmarks
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    @classmethod
+    def build(cls, graph, count):
         '''
-        Note: Remove line 85-86 will result in inefficiency of the algorithm, which takes long time to find
-        the optimal path with repeated nodes.
+        Pick landmarks by farthest selection: each new landmark is the city farthest from all landmarks
+        chosen so far, starting from the city farthest from city 0
         '''
-        if node.city in visited:
+        count = min(count, len(graph))
+        landmarks = []
+        distances = np.empty((count, len(graph)))
+        closest = shortest_distances(graph, 0) if len(graph) else np.empty(0)
+        for idx in range(count):
+            closest = closest.copy()
+            closest[landmarks] = -1.0
+            landmark = int(np.argmax(closest))
+            landmarks.append(landmark)
+            distances[idx] = shortest_distances(graph, landmark)
+            closest = distances[idx] if idx == 0 else np.minimum(closest, distances[idx])
+        return cls(np.array(landmarks, dtype=np.int32), distances)
+
+    def lower_bounds(self, target):
+        if not len(self.landmarks):
+            return np.zeros(self.distances.shape[1])
+        to_target = self.distances[:, target:target + 1]
+        with np.errstate(invalid='ignore'):
+            bounds = np.abs(self.distances - to_target)
+        # A landmark in another component says nothing about the distance
+        bounds[~np.isfinite(bounds)] = 0.0
+        return bounds.max(axis=0)
+
+def load_landmarks(graph, data_file, count, cache_file=None):
+    '''
+    Landmark tables are persisted next to the graph cache and rebuilt when the source file changes or a
+    different number of landmarks is asked for
+    '''
+    cache_file = cache_file or data_file + '.alt'
+    sections = read_sections(cache_file, data_file)
+    if sections is not None and len(sections['landmarks']) == min(count, len(graph)):
+        landmarks = sections['landmarks']
+        return LandmarkTable(landmarks, sections['distances'].reshape(len(landmarks), len(graph)))
+
+    table = LandmarkTable.build(graph, count)
+    try:
+        write_sections(cache_file, data_file, {
+            'landmarks': table.landmarks,
+            'distances': table.distances.ravel()
+        })
+    except OSError:
+        pass
+    return table
+
+def _witness_search(adjacency, source, excluded, limit, targets, max_settled):
+    '''
+    Dijkstra from source that ignores the excluded city and stops early once every target is settled,
+    the distance limit is passed or max_settled cities are done. The returned distances are lengths of
+    real paths, so they are always safe to use as witnesses even when the search was cut short.
+    '''
+    inf = float('inf')
+    cost = {source: 0.0}
+    frontier = [(0.0, source)]
+    remaining = len(targets)
+    settled = 0
+    while frontier and remaining and settled < max_settled:
+        city_cost, city = heappop(frontier)
+        if city_cost > cost[city]:
             continue
-        if node.isGoal(destination_point):
-            sys.stdout.write(f'Target found: {node.city} {node.lat} {node.long}\n')
-            return restructure_path(node, start_point, reached, frontier)
-        
-        visited.add(node.city)
-        sys.stdout.write(f'Expanding: {node.city})\n')
-        for i in city_distance[node.city]:
-            city_name = str(list(i.keys())[0])
-            input_distance = parse_city_distance(city_distance, node.city, city_name)
-            child = TreeNode(
-                city_name, 
-                lat=city_location[city_name][0], 
-                long=city_location[city_name][1],
-                cost = input_distance
-            )
-            
-            child_cost = node.cost + haversine((node.lat, node.long), \
-                (city_location[destination_point][0], city_location[destination_point][1]), unit=Unit.MILES)
-
-            frontier.add(child, priority=child_cost)
-            if child.city not in reached or child_cost < cost[child.city]:
-                reached.update({child.city:node})
-                cost[child.city] = child_cost
-                
-    return -1
+        if city_cost > limit:
+            break
+        if city in targets:
+            remaining -= 1
+        settled += 1
+        for child, input_distance in adjacency[city].items():
+            child_cost = city_cost + input_distance
+            if child != excluded and child_cost < cost.get(child, inf):
+                cost[child] = child_cost
+                heappush(frontier, (child_cost, child))
+    return cost
+
+class ContractionHierarchy():
+    '''
+    Contraction hierarchy over the undirected road graph. Cities are contracted one by one in rank order;
+    whenever removing a city would lengthen a shortest path between two of its neighbors, a shortcut
+    remembering the contracted middle city is added between them. Every road and shortcut ends up stored
+    once, CSR-style, at its lower-ranked endpoint, so a query only ever searches upwards from both ends.
+    '''
+    def __init__(self, rank, offsets, targets, weights, middle):
+        self.rank = rank
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.middle = middle
+
+    @classmethod
+    def build(cls, graph, max_settled=60):
+        inf = float('inf')
+        adjacency = [{} for _ in range(len(graph))]
+        for city in range(len(graph)):
+            neighbors, distances = graph.edges(city)
+            for child, input_distance in zip(neighbors, distances):
+                if child != city and input_distance < adjacency[city].get(child, inf):
+                    adjacency[city][child] = input_distance
+
+        # Roads longer than some other route between their ends are never on a shortest path. Dropping
+        # one leaves every distance unchanged, so they are removed as soon as they are found, which
+        # keeps the later searches small.
+        for city in range(len(graph)):
+            if adjacency[city]:
+                cost = _witness_search(adjacency, city, -1, max(adjacency[city].values()),
+                                       set(adjacency[city]), len(graph))
+                for child, input_distance in list(adjacency[city].items()):
+                    if cost[child] < input_distance:
+                        del adjacency[city][child]
+                        del adjacency[child][city]
+
+        def shortcuts_for(city):
+            '''
+            Shortcuts (source, target, length) needed to remove city without lengthening any shortest path
+            '''
+            shortcuts = []
+            neighbors = list(adjacency[city].items())
+            for idx, (source, to_city) in enumerate(neighbors):
+                targets = {target: to_city + from_city for target, from_city in neighbors[idx + 1:]}
+                if not targets:
+                    continue
+                cost = _witness_search(adjacency, source, city, max(targets.values()), targets, max_settled)
+                shortcuts.extend((source, target, via_city) for target, via_city in targets.items()
+                                 if cost.get(target, inf) > via_city)
+            return shortcuts
+
+        def priority(city, shortcuts):
+            # Edge difference plus the number of already contracted neighbors, to spread contraction evenly
+            return len(shortcuts) - len(adjacency[city]) + deleted[city]
+
+        middle = {}
+        deleted = [0] * len(graph)
+        queue = [(priority(city, shortcuts_for(city)), city) for city in range(len(graph))]
+        queue.sort()
+        rank = np.empty(len(graph), dtype=np.int32)
+        upward = []
+        while queue:
+            _, city = heappop(queue)
+            # Lazy update: the stored priority may be outdated since neighbors were contracted
+            shortcuts = shortcuts_for(city)
+            current = priority(city, shortcuts)
+            if queue and current > queue[0][0]:
+                heappush(queue, (current, city))
+                continue
+
+            for source, target, via_city in shortcuts:
+                adjacency[source][target] = adjacency[target][source] = via_city
+                middle[min(source, target), max(source, target)] = city
+            rank[city] = len(upward)
+            upward.append([
+                (neighbor, input_distance, middle.get((min(city, neighbor), max(city, neighbor)), -1))
+                for neighbor, input_distance in adjacency[city].items()
+            ])
+            for neighbor in adjacency[city]:
+                del adjacency[neighbor][city]
+                deleted[neighbor] += 1
+            adjacency[city] = {}
+
+        offsets = np.zeros(len(graph) + 1, dtype=np.int64)
+        np.cumsum([len(upward[rank[city]]) for city in range(len(graph))], out=offsets[1:])
+        edges = [edge for city in range(len(graph)) for edge in upward[rank[city]]]
+        return cls(
+            rank,
+            offsets,
+            np.array([edge[0] for edge in edges], dtype=np.int32),
+            np.array([edge[1] for edge in edges], dtype=np.float64),
+            np.array([edge[2] for edge in edges], dtype=np.int32)
+        )
+
+    def upward_edges(self, city):
+        first, last = self.offsets[city], self.offsets[city + 1]
+        return self.targets[first:last].tolist(), self.weights[first:last].tolist()
+
+    def unpack(self, first_city, second_city):
+        '''
+        Expand the road or shortcut between two cities into the original cities it stands for and the
+        length of each of those roads
+        '''
+        route = [first_city]
+        legs = []
+        pending = [(first_city, second_city)]
+        while pending:
+            source, target = pending.pop()
+            lower, upper = (source, target) if self.rank[source] < self.rank[target] else (target, source)
+            first, last = self.offsets[lower], self.offsets[lower + 1]
+            position = first + self.targets[first:last].tolist().index(upper)
+            via_city = int(self.middle[position])
+            if via_city == -1:
+                route.append(target)
+                legs.append(float(self.weights[position]))
+            else:
+                # Depth-first on a stack: handle the first half before the second
+                pending.append((via_city, target))
+                pending.append((source, via_city))
+        return route, legs
+
+def load_hierarchy(graph, data_file, cache_file=None):
+    '''
+    Contraction hierarchies are persisted next to the graph cache and rebuilt when the source file changes
+    '''
+    cache_file = cache_file or data_file + '.ch'
+    sections = read_sections(cache_file, data_file)
+    if sections is not None:
+        return ContractionHierarchy(
+            sections['rank'], sections['offsets'], sections['targets'], sections['weights'], sections['middle']
+        )
+
+    hierarchy = ContractionHierarchy.build(graph)
+    save_hierarchy(hierarchy, data_file, cache_file)
+    return hierarchy
+
+def save_hierarchy(hierarchy, data_file, cache_file=None):
+    # A read-only data directory just means the hierarchy is rebuilt next time
+    try:
+        write_sections(cache_file or data_file + '.ch', data_file, {
+            'rank': hierarchy.rank,
+            'offsets': hierarchy.offsets,
+            'targets': hierarchy.targets,
+            'weights': hierarchy.weights,
+            'middle': hierarchy.middle
+        })
+    except OSError:
+        pass
+
+class SearchStats():
+    '''
+    Counters and wall-clock phase timings collected by the searches. Pass an instance as stats= to
+    find_route to have it filled in; one instance can be shared by many searches and sums them up.
+    Subclasses may override on_expand to observe every expanded city.
+    '''
+    def __init__(self):
+        self.searches = 0
+        self.expansions = 0
+        self.pushes = 0
+        self.stale_pops = 0
+        self.peak_frontier = 0
+        self.heuristic_evaluations = 0
+        self.phases = {}
+
+    def on_expand(self, city, cost):
+        pass
+
+    def record(self, expansions, pushes, stale_pops, peak_frontier, heuristic_evaluations):
+        self.searches += 1
+        self.expansions += expansions
+        self.pushes += pushes
+        self.stale_pops += stale_pops
+        self.peak_frontier = max(self.peak_frontier, peak_frontier)
+        self.heuristic_evaluations += heuristic_evaluations
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        began = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - began)
+
+    def merge(self, other):
+        self.searches += other.searches
+        self.expansions += other.expansions
+        self.pushes += other.pushes
+        self.stale_pops += other.stale_pops
+        self.peak_frontier = max(self.peak_frontier, other.peak_frontier)
+        self.heuristic_evaluations += other.heuristic_evaluations
+        for name, seconds in other.phases.items():
+            self.add_time(name, seconds)
+        return self
+
+    def to_dict(self):
+        return {
+            'searches': self.searches,
+            'expansions': self.expansions,
+            'pushes': self.pushes,
+            'stale_pops': self.stale_pops,
+            'peak_frontier': self.peak_frontier,
+            'heuristic_evaluations': self.heuristic_evaluations,
+            'phases': dict(self.phases)
+        }
+
+def timed_phase(stats, name):
+    return stats.phase(name) if stats is not None else nullcontext()
+
+class RouteResult():
+    '''
+    Route found by a search: city ids from start to goal, the road distance of every leg and the search
+    statistics. Names are only looked up while writing, so results stay cheap to keep and to pickle.
+    '''
+    def __init__(self, cities, legs, nodes_generated, frontier_size):
+        self.cities = cities
+        self.legs = legs
+        self.nodes_generated = nodes_generated
+        self.frontier_size = frontier_size
+
+    @property
+    def cumulative(self):
+        return list(accumulate(self.legs, initial=0.0))
+
+    @property
+    def distance(self):
+        return self.cumulative[-1]
+
+    def route(self, graph):
+        return [graph.names[city] for city in self.cities]
+
+    def to_dict(self, graph):
+        return {
+            'route': self.route(graph),
+            'legs': list(self.legs),
+            'distance': self.distance,
+            'nodes_generated': self.nodes_generated,
+            'frontier': self.frontier_size
+        }
+
+    def write_json(self, stream, graph, stats=None, **fields):
+        '''
+        Write the result as one JSON line, city by city, after any extra leading fields and followed by
+        the search stats when given
+        '''
+        stream.write('{')
+        for key, value in fields.items():
+            stream.write(f'{json.dumps(key)}: {json.dumps(value)}, ')
+        stream.write('"route": [')
+        for idx, city in enumerate(self.cities):
+            stream.write(', ' + json.dumps(graph.names[city]) if idx else json.dumps(graph.names[city]))
+        stream.write('], "legs": ')
+        stream.write(json.dumps(list(self.legs)))
+        stream.write(f', "distance": {json.dumps(self.distance)}, "nodes_generated": {self.nodes_generated}, ')
+        stream.write(f'"frontier": {self.frontier_size}')
+        if stats is not None:
+            stream.write(', "stats": ')
+            stream.write(json.dumps(stats.to_dict()))
+        stream.write('}\n')
+
+    def write_text(self, stream, graph):
+        stream.write('Route found: ')
+        for city in self.cities:
+            stream.write(graph.names[city])
+            stream.write(' ')
+        stream.write(f'\nDistance: {self.distance} miles\n')
+        stream.write(f'Total nodes generated: {self.nodes_generated}\n')
+        stream.write(f'Nodes left in frontier: {self.frontier_size}\n')
+
+def restructure_path(goal, start, parent, leg, generated, frontier, graph, trace=True):
+    '''
+    Trace back the most optimal path over the parent array in linear time, with the length of the road
+    leading into each city taken from leg
+    '''
+    cities = [goal]
+    legs = []
+    curr_city = goal
+    while curr_city != start:
+        legs.append(leg[curr_city])
+        curr_city = parent[curr_city]
+        cities.append(curr_city)
+    cities.reverse()
+    legs.reverse()
+
+    result = RouteResult(cities, legs, generated, len(frontier))
+    if trace:
+        result.write_text(sys.stdout, graph)
+    return result
+
+def expansion_hook(graph, trace, stats):
+    '''
+    The callback a search runs for every expanded city: the trace line, the stats hook, both or none.
+    None means the search loop pays nothing for observation at all.
+    '''
+    observed = stats is not None and type(stats).on_expand is not SearchStats.on_expand
+    if not trace:
+        return stats.on_expand if observed else None
+
+    def expand(city, city_cost):
+        sys.stdout.write(f'Expanding: {graph.names[city]})\n')
+        if observed:
+            stats.on_expand(city, city_cost)
+    return expand
+
+def calculate_optimal_path(start_point, destination_point, graph, trace=True, landmarks=None, stats=None):
+    '''
+    A* search between two city names, ordered by f = g + h with h the great-circle distance to the goal
+    (or the landmark bound, when larger).
+    Improved paths are pushed again instead of decreasing keys; outdated heap entries are recognised by
+    their g value when popped. Ties on f prefer the city closer to the goal, then the lower city id.
+    With trace off nothing is written per node, which is what batch callers want.
+    '''
+    began = time.perf_counter() if stats is not None else 0.0
+    if trace:
+        sys.stdout.write(f'Search for a path from {start_point} to {destination_point}...\n')
+
+    start = graph.city_id[start_point]
+    goal = graph.city_id[destination_point]
+    remaining = heuristic_table(graph, goal, landmarks)
+    expand = expansion_hook(graph, trace, stats)
+    inf = float('inf')
+    cost = [inf] * len(graph)
+    parent = array('i', [-1]) * len(graph)
+    leg = array('d', [0.0]) * len(graph)
+    visited = bytearray(len(graph))
+    cost[start] = 0.0
+    parent[start] = start
+    frontier = [(remaining[start], remaining[start], start, 0.0)]
+    generated = 1
+    pushes, stale_pops, peak_frontier = 1, 0, 1
+
+    found = False
+    while frontier:
+        if len(frontier) > peak_frontier:
+            peak_frontier = len(frontier)
+        _, _, city, city_cost = heappop(frontier)
+        if visited[city] or city_cost > cost[city]:
+            stale_pops += 1
+            continue
+        if city == goal:
+            if trace:
+                lat, lon = graph.location(city)
+                sys.stdout.write(f'Target found: {graph.names[city]} {lat} {lon}\n')
+            found = True
+            break
+
+        visited[city] = 1
+        if expand is not None:
+            expand(city, city_cost)
+        neighbors, distances = graph.edges(city)
+        for child, input_distance in zip(neighbors, distances):
+            child_cost = city_cost + input_distance
+            if child_cost < cost[child]:
+                if cost[child] == inf:
+                    generated += 1
+                cost[child] = child_cost
+                parent[child] = city
+                leg[child] = input_distance
+                pushes += 1
+                heappush(frontier, (child_cost + remaining[child], remaining[child], child, child_cost))
+
+    searched = time.perf_counter() if stats is not None else 0.0
+    result = restructure_path(goal, start, parent, leg, generated, frontier, graph, trace) if found else -1
+    if stats is not None:
+        stats.record(visited.count(1), pushes, stale_pops, peak_frontier, len(graph))
+        stats.add_time('search', searched - began)
+        stats.add_time('reconstruct', time.perf_counter() - searched)
+    return result
+
+def bidirectional_path(start_point, destination_point, graph, trace=True, landmarks=None, stats=None):
+    '''
+    Bidirectional A* with average potentials: p(v) = (h_goal(v) - h_start(v)) / 2 drives the forward
+    search and -p(v) the backward one, which keeps both consistent. Once the smallest forward and
+    backward keys add up to the best meeting distance found so far, that distance is optimal.
+    '''
+    began = time.perf_counter() if stats is not None else 0.0
+    if trace:
+        sys.stdout.write(f'Search for a path from {start_point} to {destination_point}...\n')
+
+    start = graph.city_id[start_point]
+    goal = graph.city_id[destination_point]
+    to_goal = heuristic_table(graph, goal, landmarks)
+    to_start = heuristic_table(graph, start, landmarks)
+    potential = [(h_goal - h_start) / 2 for h_goal, h_start in zip(to_goal, to_start)]
+    expand = expansion_hook(graph, trace, stats)
+
+    inf = float('inf')
+    cost = ([inf] * len(graph), [inf] * len(graph))
+    parent = (array('i', [-1]) * len(graph), array('i', [-1]) * len(graph))
+    leg = (array('d', [0.0]) * len(graph), array('d', [0.0]) * len(graph))
+    visited = (bytearray(len(graph)), bytearray(len(graph)))
+    frontier = ([], [])
+    sign = (1.0, -1.0)
+    for side, city in ((0, start), (1, goal)):
+        cost[side][city] = 0.0
+        parent[side][city] = city
+        heappush(frontier[side], (sign[side] * potential[city], city, 0.0))
+    pushes, stale_pops, peak_frontier = 2, 0, 2
+
+    best, meeting = (0.0, start) if start == goal else (inf, -1)
+    while frontier[0] and frontier[1]:
+        if frontier[0][0][0] + frontier[1][0][0] >= best:
+            break
+        if len(frontier[0]) + len(frontier[1]) > peak_frontier:
+            peak_frontier = len(frontier[0]) + len(frontier[1])
+        side = 0 if frontier[0][0][0] <= frontier[1][0][0] else 1
+        _, city, city_cost = heappop(frontier[side])
+        if visited[side][city] or city_cost > cost[side][city]:
+            stale_pops += 1
+            continue
+        visited[side][city] = 1
+        if expand is not None:
+            expand(city, city_cost)
+
+        own_cost, own_parent, own_leg, other_cost = cost[side], parent[side], leg[side], cost[1 - side]
+        neighbors, distances = graph.edges(city)
+        for child, input_distance in zip(neighbors, distances):
+            child_cost = city_cost + input_distance
+            if child_cost < own_cost[child]:
+                own_cost[child] = child_cost
+                own_parent[child] = city
+                own_leg[child] = input_distance
+                pushes += 1
+                heappush(frontier[side], (child_cost + sign[side] * potential[child], child, child_cost))
+                if child_cost + other_cost[child] < best:
+                    best = child_cost + other_cost[child]
+                    meeting = child
+
+    searched = time.perf_counter() if stats is not None else 0.0
+    result = -1
+    if meeting != -1:
+        if trace:
+            lat, lon = graph.location(goal)
+            sys.stdout.write(f'Target found: {graph.names[goal]} {lat} {lon}\n')
+
+        # Splice the backward tree onto the forward one so restructure_path can walk a single parent chain
+        joined, joined_leg = parent[0], leg[0]
+        city = meeting
+        while city != goal:
+            joined[parent[1][city]] = city
+            joined_leg[parent[1][city]] = leg[1][city]
+            city = parent[1][city]
+        generated = sum(1 for forward, backward in zip(cost[0], cost[1]) if forward < inf or backward < inf)
+        result = restructure_path(goal, start, joined, joined_leg, generated, frontier[0] + frontier[1], graph, trace)
+    if stats is not None:
+        stats.record(visited[0].count(1) + visited[1].count(1), pushes, stale_pops, peak_frontier, 2 * len(graph))
+        stats.add_time('search', searched - began)
+        stats.add_time('reconstruct', time.perf_counter() - searched)
+    return result
+
+def hierarchy_path(start_point, destination_point, graph, trace=True, hierarchy=None, stats=None):
+    '''
+    Contraction hierarchy query: Dijkstra upwards in rank from both ends. The shortest route passes
+    through the highest-ranked city on it, which both searches settle, so each side can stop as soon as
+    its smallest key is no better than the best meeting distance. The upward route is then unpacked
+    into the original roads.
+    '''
+    began = time.perf_counter() if stats is not None else 0.0
+    if trace:
+        sys.stdout.write(f'Search for a path from {start_point} to {destination_point}...\n')
+
+    start = graph.city_id[start_point]
+    goal = graph.city_id[destination_point]
+    expand = expansion_hook(graph, trace, stats)
+    inf = float('inf')
+    cost = ({start: 0.0}, {goal: 0.0})
+    parent = ({start: start}, {goal: goal})
+    frontier = ([(0.0, start)], [(0.0, goal)])
+    expansions, pushes, stale_pops, peak_frontier = 0, 2, 0, 2
+    best, meeting = inf, -1
+    side = 0
+    while frontier[0] or frontier[1]:
+        if not frontier[side]:
+            side = 1 - side
+        if len(frontier[0]) + len(frontier[1]) > peak_frontier:
+            peak_frontier = len(frontier[0]) + len(frontier[1])
+        city_cost, city = heappop(frontier[side])
+        own_cost, own_parent = cost[side], parent[side]
+        if city_cost > own_cost[city]:
+            stale_pops += 1
+            continue
+        if city_cost >= best:
+            frontier[side].clear()
+            continue
+        expansions += 1
+        if expand is not None:
+            expand(city, city_cost)
+        if city_cost + cost[1 - side].get(city, inf) < best:
+            best = city_cost + cost[1 - side][city]
+            meeting = city
+
+        neighbors, distances = hierarchy.upward_edges(city)
+        for child, input_distance in zip(neighbors, distances):
+            child_cost = city_cost + input_distance
+            if child_cost < own_cost.get(child, inf):
+                own_cost[child] = child_cost
+                own_parent[child] = city
+                pushes += 1
+                heappush(frontier[side], (child_cost, child))
+        side = 1 - side
+
+    searched = time.perf_counter() if stats is not None else 0.0
+    result = -1
+    if meeting != -1:
+        if trace:
+            lat, lon = graph.location(goal)
+            sys.stdout.write(f'Target found: {graph.names[goal]} {lat} {lon}\n')
+
+        upward = [meeting]
+        while upward[-1] != start:
+            upward.append(parent[0][upward[-1]])
+        upward.reverse()
+        while upward[-1] != goal:
+            upward.append(parent[1][upward[-1]])
+        cities, legs = [start], []
+        for source, target in zip(upward, upward[1:]):
+            route, route_legs = hierarchy.unpack(source, target)
+            cities.extend(route[1:])
+            legs.extend(route_legs)
+
+        result = RouteResult(cities, legs, len(cost[0].keys() | cost[1].keys()), len(frontier[0]) + len(frontier[1]))
+        if trace:
+            result.write_text(sys.stdout, graph)
+    if stats is not None:
+        stats.record(expansions, pushes, stale_pops, peak_frontier, 0)
+        stats.add_time('search', searched - began)
+        stats.add_time('reconstruct', time.perf_counter() - searched)
+    return result
+
+def find_route(start_point, destination_point, graph, algorithm='astar', trace=True, landmarks=None,
+               hierarchy=None, stats=None):
+    if algorithm == 'ch':
+        return hierarchy_path(start_point, destination_point, graph, trace, hierarchy, stats)
+    if algorithm == 'bidirectional':
+        return bidirectional_path(start_point, destination_point, graph, trace, landmarks, stats)
+    return calculate_optimal_path(start_point, destination_point, graph, trace, landmarks, stats)
+
+def route_from_coordinates(start_coordinates, destination_coordinates, graph, trace=True, **search_options):
+    '''
+    Snap two (latitude, longitude) points to their nearest cities through the graph's spatial index and
+    search a route between those cities
+    '''
+    index = graph.spatial_index()
+    endpoints = []
+    for lat, lon in (start_coordinates, destination_coordinates):
+        city, miles = index.nearest(lat, lon)[0]
+        if trace:
+            sys.stdout.write(f'Snapped ({lat}, {lon}) to {graph.names[city]} ({miles:.1f} miles away)\n')
+        endpoints.append(graph.names[city])
+    return find_route(*endpoints, graph, trace=trace, **search_options)
+
+def read_route_queries(stream):
+    '''
+    Read "start, end" pairs, one per line, in the same format as the road lines of the data file.
+    Blank lines and lines starting with # are skipped. A line that is not a pair is yielded as the
+    plain string, so the batch can report it and carry on.
+    '''
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        start_point, separator, destination_point = line.partition(', ')
+        if not separator:
+            yield line
+            continue
+        yield start_point, destination_point
+
+def malformed_query(line):
+    return f'Expected "start, end" but got: {line}'
+
+def route_query(graph, start_point, destination_point, stats=None, **search_options):
+    '''
+    Answer one batch query with a RouteResult. Unknown cities and unreachable targets come back as an
+    error message instead of an exception, so one bad line does not abort a whole batch.
+    '''
+    for point in (start_point, destination_point):
+        if point not in graph:
+            return f'No city found: {point}'
+    solution = find_route(start_point, destination_point, graph, trace=False, stats=stats, **search_options)
+    return 'No route found' if solution == -1 else solution
+
+def load_search_options(graph, data_file, algorithm='astar', landmark_count=0):
+    '''
+    Keyword arguments for find_route, loading any preprocessing the chosen search needs
+    '''
+    options = {'algorithm': algorithm}
+    if landmark_count > 0:
+        options['landmarks'] = load_landmarks(graph, data_file, landmark_count)
+    if algorithm == 'ch':
+        options['hierarchy'] = load_hierarchy(graph, data_file)
+    return options
+
+_worker_graph = None
+_worker_options = {}
+
+def _init_route_worker(data_file, cache_file, algorithm, landmark_count):
+    # Every worker maps the same compiled caches, so the graph pages are shared read-only
+    global _worker_graph, _worker_options
+    _worker_graph = load_graph(data_file, cache_file, verbose=False)
+    _worker_options = load_search_options(_worker_graph, data_file, algorithm, landmark_count)
+
+def _route_worker(task):
+    query, collect_stats = task
+    if isinstance(query, str):
+        return query, malformed_query(query), None
+    stats = SearchStats() if collect_stats else None
+    return query, route_query(_worker_graph, *query, stats=stats, **_worker_options), stats
+
+def plan_routes(graph, queries, workers=1, data_file=None, cache_file=None, chunksize=64,
+                algorithm='astar', landmark_count=0, collect_stats=False):
+    '''
+    Yield ((start, end), RouteResult or error message, SearchStats or None) per query, in input order.
+    Malformed lines from read_route_queries come back as (line, error message, None).
+    With more than one worker the queries are fanned out over a process pool whose workers load the
+    graph from the compiled cache of data_file.
+    '''
+    if workers <= 1 or data_file is None:
+        options = load_search_options(graph, data_file, algorithm, landmark_count)
+        for query in queries:
+            if isinstance(query, str):
+                yield query, malformed_query(query), None
+                continue
+            stats = SearchStats() if collect_stats else None
+            yield query, route_query(graph, *query, stats=stats, **options), stats
+        return
+
+    # Build any missing preprocessing once, before the workers race to create it
+    load_search_options(graph, data_file, algorithm, landmark_count)
+    initargs = (data_file, cache_file, algorithm, landmark_count)
+    tasks = ((query, collect_stats) for query in queries)
+    with multiprocessing.Pool(workers, initializer=_init_route_worker, initargs=initargs) as pool:
+        yield from pool.imap(_route_worker, tasks, chunksize=chunksize)
+
+def distance_row(graph, source, targets):
+    '''
+    Road distances from source to each target. The Dijkstra sweep stops as soon as every target is
+    settled, so rows for nearby targets cost far less than a full one-to-all search.
+    '''
+    inf = float('inf')
+    cost = {source: 0.0}
+    frontier = [(0.0, source)]
+    pending = set(targets)
+    while frontier and pending:
+        city_cost, city = heappop(frontier)
+        if city_cost > cost[city]:
+            continue
+        pending.discard(city)
+        neighbors, distances = graph.edges(city)
+        for child, input_distance in zip(neighbors, distances):
+            child_cost = city_cost + input_distance
+            if child_cost < cost.get(child, inf):
+                cost[child] = child_cost
+                heappush(frontier, (child_cost, child))
+    return np.array([cost.get(target, inf) for target in targets])
+
+def upward_distances(hierarchy, source):
+    '''
+    Distances from source to every city reachable by going upwards in a contraction hierarchy
+    '''
+    inf = float('inf')
+    cost = {source: 0.0}
+    frontier = [(0.0, source)]
+    while frontier:
+        city_cost, city = heappop(frontier)
+        if city_cost > cost[city]:
+            continue
+        neighbors, distances = hierarchy.upward_edges(city)
+        for child, input_distance in zip(neighbors, distances):
+            child_cost = city_cost + input_distance
+            if child_cost < cost.get(child, inf):
+                cost[child] = child_cost
+                heappush(frontier, (child_cost, child))
+    return cost
+
+def target_buckets(hierarchy, targets):
+    '''
+    Bucket-based many-to-many: every city reached by a target's upward search keeps a bucket of
+    (target column, distance) entries, which the source searches then scan
+    '''
+    buckets = {}
+    for column, target in enumerate(targets):
+        for city, city_cost in upward_distances(hierarchy, target).items():
+            buckets.setdefault(city, []).append((column, city_cost))
+    return buckets
+
+def bucket_row(hierarchy, source, buckets, target_count):
+    row = [float('inf')] * target_count
+    for city, city_cost in upward_distances(hierarchy, source).items():
+        for column, target_cost in buckets.get(city, ()):
+            if city_cost + target_cost < row[column]:
+                row[column] = city_cost + target_cost
+    return np.array(row)
+
+_worker_matrix = {}
+
+def _init_matrix_worker(data_file, targets, use_hierarchy):
+    global _worker_graph
+    _worker_graph = load_graph(data_file, verbose=False)
+    _worker_matrix['targets'] = targets
+    if use_hierarchy:
+        _worker_matrix['hierarchy'] = load_hierarchy(_worker_graph, data_file)
+        _worker_matrix['buckets'] = target_buckets(_worker_matrix['hierarchy'], targets)
+
+def _matrix_worker(sources):
+    targets = _worker_matrix['targets']
+    if 'hierarchy' in _worker_matrix:
+        return [bucket_row(_worker_matrix['hierarchy'], source, _worker_matrix['buckets'], len(targets))
+                for source in sources]
+    return [distance_row(_worker_graph, source, targets) for source in sources]
+
+def distance_matrix(graph, source_points, target_points, hierarchy=None, workers=1, data_file=None, chunksize=16):
+    '''
+    Matrix of road distances from every source city to every target city (infinity when unreachable).
+    Rows come from one early-terminating Dijkstra per source, or from bucket scans over a contraction
+    hierarchy when one is given. With more than one worker the sources are split over a process pool
+    whose workers load the compiled caches of data_file.
+    '''
+    sources = [graph.city_id[point] for point in source_points]
+    targets = [graph.city_id[point] for point in target_points]
+    matrix = np.empty((len(sources), len(targets)))
+    if workers <= 1 or data_file is None:
+        if hierarchy is not None:
+            buckets = target_buckets(hierarchy, targets)
+            for idx, source in enumerate(sources):
+                matrix[idx] = bucket_row(hierarchy, source, buckets, len(targets))
+        else:
+            for idx, source in enumerate(sources):
+                matrix[idx] = distance_row(graph, source, targets)
+        return matrix
+
+    chunks = [sources[idx:idx + chunksize] for idx in range(0, len(sources), chunksize)]
+    initargs = (data_file, targets, hierarchy is not None)
+    with multiprocessing.Pool(workers, initializer=_init_matrix_worker, initargs=initargs) as pool:
+        idx = 0
+        for rows in pool.imap(_matrix_worker, chunks):
+            for row in rows:
+                matrix[idx] = row
+                idx += 1
+    return matrix
+
+def read_city_list(file_name):
+    with open(file_name) as city_file:
+        return [line.strip() for line in city_file if line.strip() and not line.startswith('#')]
+
+def write_matrix(matrix, source_points, target_points, output_file):
+    '''
+    Save a distance matrix as .npy, or as CSV with the city names as header row and first column
+    '''
+    if output_file.endswith('.npy'):
+        np.save(output_file, matrix)
+        return
+    output_stream = sys.stdout if output_file == '-' else open(output_file, 'w', newline='')
+    try:
+        writer = csv.writer(output_stream)
+        writer.writerow([''] + list(target_points))
+        for point, row in zip(source_points, matrix):
+            writer.writerow([point] + row.tolist())
+    finally:
+        if output_stream is not sys.stdout:
+            output_stream.close()
+
+def run_batch(graph, query_file, output_file, workers=1, data_file=None, stats=None, **search_options):
+    '''
+    Answer every query of query_file (- for stdin) and write the results as JSONL to output_file (- for stdout).
+    When a SearchStats is given, every line carries its own search stats and stats receives the totals.
+    '''
+    query_stream = sys.stdin if query_file == '-' else open(query_file)
+    output_stream = sys.stdout if output_file == '-' else open(output_file, 'w')
+    try:
+        for query, solution, query_stats in plan_routes(
+                graph, read_route_queries(query_stream), workers, data_file, collect_stats=stats is not None,
+                **search_options):
+            if isinstance(query, str):
+                output_stream.write(json.dumps({'query': query, 'error': solution}) + '\n')
+                continue
+            start_point, destination_point = query
+            if query_stats is not None:
+                stats.merge(query_stats)
+            if isinstance(solution, RouteResult):
+                solution.write_json(output_stream, graph, query_stats, start=start_point, end=destination_point)
+            else:
+                failure = {'start': start_point, 'end': destination_point, 'error': solution}
+                if query_stats is not None:
+                    failure['stats'] = query_stats.to_dict()
+                output_stream.write(json.dumps(failure) + '\n')
+    finally:
+        if query_stream is not sys.stdin:
+            query_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+
+def benchmark_routing(graph, data_file, query_count=200, seed=0):
+    '''
+    Build the contraction hierarchy from scratch, then answer the same random queries with plain A* and
+    with the hierarchy. Returns preprocessing time, mean query times and the speedup, and checks that
+    both searches agree on every distance. Pairs with no route count as unreachable, and as a mismatch
+    if only one search finds a route.
+    '''
+    preprocessing_start = time.perf_counter()
+    hierarchy = ContractionHierarchy.build(graph)
+    preprocessing = time.perf_counter() - preprocessing_start
+    save_hierarchy(hierarchy, data_file)
+
+    generator = random.Random(seed)
+    queries = [(generator.choice(graph.names), generator.choice(graph.names)) for _ in range(query_count)]
+    timings = {}
+    distances = {}
+    for algorithm, options in (('astar', {}), ('ch', {'hierarchy': hierarchy})):
+        search_start = time.perf_counter()
+        solutions = [find_route(start_point, destination_point, graph, algorithm, trace=False, **options)
+                     for start_point, destination_point in queries]
+        distances[algorithm] = [None if solution == -1 else solution.distance for solution in solutions]
+        timings[algorithm] = (time.perf_counter() - search_start) / max(query_count, 1)
+
+    unreachable = 0
+    mismatches = 0
+    for expected, found in zip(distances['astar'], distances['ch']):
+        if expected is None and found is None:
+            unreachable += 1
+        elif expected is None or found is None or abs(expected - found) > 1e-6:
+            mismatches += 1
+    return {
+        'cities': len(graph),
+        'roads': len(graph.neighbors) // 2,
+        'hierarchy_edges': len(hierarchy.targets),
+        'queries': query_count,
+        'unreachable_queries': unreachable,
+        'preprocessing_seconds': preprocessing,
+        'astar_query_ms': timings['astar'] * 1000,
+        'ch_query_ms': timings['ch'] * 1000,
+        'speedup': timings['astar'] / timings['ch'] if timings['ch'] else None,
+        'distance_mismatches': mismatches
+    }
 
 def get_user_input(location):
     '''
@@ -142,7 +1178,7 @@ def get_user_input(location):
         elif starting_point == '0' or destination_point == '0':
             sys.exit("Goodbye.\n")
 
-def parse_city_data_file(data_file):
+def parse_city_data_file(data_file, verbose=True):
     city_data_regex = re.compile(r"(?P<city>^.+) "
                                  r"(?P<lat>-*\d+\.\d+) "
                                  r"(?P<lon>-*\d+\.\d+)"
@@ -153,41 +1189,271 @@ def parse_city_data_file(data_file):
                                      r"(?P<dist>-?\d+.\d+)"
                                     )
 
-    city_location = defaultdict(list)
-    city_distance = defaultdict(list)
-    city_count = 0
+    names, latitudes, longitudes = [], [], []
+    city_id = {}
+    roads, distances = [], []
     with open(data_file) as city_file:
-        for line in city_file.readlines():
-            city_result = city_data_regex.search(line)
+        for line_number, line in enumerate(city_file, 1):
+            # Road lines are the bulk of the file, so try them first and only fall back to the city regex
             city_distance_result = city_distance_regex.search(line)
+            if city_distance_result != None:
+                # Cities may be listed after their roads, so names are resolved once the whole file is read
+                roads.append((line_number, city_distance_result.group('city1'), city_distance_result.group('city2')))
+                distances.append(float(city_distance_result.group('dist')))
+                continue
+
+            city_result = city_data_regex.search(line)
             if city_result != None:
                 city_name = city_result.group('city')
-                latitude = float(city_result.group('lat'))
-                longitude = float(city_result.group('lon'))
-    
-                city_count = city_count + 1
-                city_location[city_name].append(latitude)
-                city_location[city_name].append(longitude)
-               
-            elif city_distance_result != None:
-                city1_name = city_distance_result.group('city1')
-                city2_name = city_distance_result.group('city2')
-                distance = float(city_distance_result.group('dist'))
-                city_distance[city1_name].append({
-                    city2_name: distance
-                })
-                city_distance[city2_name].append({
-                    city1_name: distance
-                })
-    sys.stdout.write("Reading data .... Done\n")
-    sys.stdout.write(f'Number of cities: {city_count}\n')
-    return city_location, city_distance
+                city_id[city_name] = len(names)
+                names.append(city_name)
+                latitudes.append(float(city_result.group('lat')))
+                longitudes.append(float(city_result.group('lon')))
+
+    sources, targets = [], []
+    for line_number, first_city, second_city in roads:
+        for city in (first_city, second_city):
+            if city not in city_id:
+                raise ValueError(f'{data_file}, line {line_number}: road to unknown city {city!r}')
+        sources.append(city_id[first_city])
+        targets.append(city_id[second_city])
+
+    graph = RoadGraph.from_edges(names, latitudes, longitudes, sources, targets, distances)
+    if verbose:
+        sys.stdout.write("Reading data .... Done\n")
+        sys.stdout.write(f'Number of cities: {len(graph)}\n')
+    return graph
+
+def source_digest(data_file):
+    digest = hashlib.sha256()
+    with open(data_file, 'rb') as source:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+def write_sections(cache_file, data_file, sections):
+    '''
+    Write named 1-D arrays into a versioned binary container stamped with the source file's mtime,
+    size and hash. Every array starts on an 8-byte boundary so it can be mapped back without copying.
+    '''
+    source_stat = os.stat(data_file)
+    arrays = [(name, np.ascontiguousarray(values)) for name, values in sections.items()]
+    offset = CACHE_HEADER.size + CACHE_SECTION.size * len(arrays)
+    directory = []
+    for name, values in arrays:
+        offset += -offset % 8
+        directory.append(CACHE_SECTION.pack(name.encode(), values.dtype.str.encode(), offset, values.size))
+        offset += values.nbytes
+
+    # Write next to the target and rename, so readers never map a half-written file
+    temp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(temp_file, 'wb') as cache:
+        cache.write(CACHE_HEADER.pack(
+            GRAPH_CACHE_MAGIC, GRAPH_CACHE_VERSION, len(arrays),
+            source_stat.st_mtime_ns, source_stat.st_size, source_digest(data_file)
+        ))
+        for entry in directory:
+            cache.write(entry)
+        for name, values in arrays:
+            cache.write(b'\x00' * (-cache.tell() % 8))
+            cache.write(values.tobytes())
+    os.replace(temp_file, cache_file)
+
+def read_sections(cache_file, data_file):
+    '''
+    Memory-map a container written by write_sections and return its arrays as read-only views, or None
+    when the file is missing, truncated or corrupt, from another format version, or stale with respect
+    to the source text.
+    '''
+    try:
+        with open(cache_file, 'rb') as cache:
+            mapped = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mapped) < CACHE_HEADER.size:
+        mapped.close()
+        return None
+
+    magic, version, section_count, mtime_ns, size, digest = CACHE_HEADER.unpack_from(mapped, 0)
+    if magic != GRAPH_CACHE_MAGIC or version != GRAPH_CACHE_VERSION:
+        mapped.close()
+        return None
+    source_stat = os.stat(data_file)
+    if (source_stat.st_mtime_ns, source_stat.st_size) != (mtime_ns, size):
+        # The file was touched; only rebuild when its content really changed
+        if source_stat.st_size != size or source_digest(data_file) != digest:
+            mapped.close()
+            return None
+        try:
+            with open(cache_file, 'r+b') as cache:
+                cache.write(CACHE_HEADER.pack(
+                    magic, version, section_count, source_stat.st_mtime_ns, source_stat.st_size, digest
+                ))
+        except OSError:
+            # Read-only cache: the content matched, so the sections are still good; the hash is just
+            # checked again next time
+            pass
+
+    # Check the whole directory before mapping anything, so a truncated file is rebuilt instead of read
+    entries = []
+    if CACHE_HEADER.size + section_count * CACHE_SECTION.size > len(mapped):
+        mapped.close()
+        return None
+    for idx in range(section_count):
+        name, dtype, offset, count = CACHE_SECTION.unpack_from(mapped, CACHE_HEADER.size + idx * CACHE_SECTION.size)
+        try:
+            name = name.rstrip(b'\x00').decode()
+            dtype = np.dtype(dtype.rstrip(b'\x00').decode())
+        except (UnicodeDecodeError, TypeError, ValueError):
+            mapped.close()
+            return None
+        if dtype.itemsize == 0 or offset < 0 or count < 0 or offset + count * dtype.itemsize > len(mapped):
+            mapped.close()
+            return None
+        entries.append((name, dtype, offset, count))
+
+    return {
+        name: np.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+        for name, dtype, offset, count in entries
+    }
+
+def compile_graph(data_file, cache_file=None):
+    '''
+    Parse the city file once and store the graph as a binary cache next to it
+    '''
+    cache_file = cache_file or data_file + '.graph'
+    graph = parse_city_data_file(data_file, verbose=False)
+    names = '\n'.join(graph.names).encode()
+    write_sections(cache_file, data_file, {
+        'names': np.frombuffer(names, dtype=np.uint8),
+        'lat': graph.lat,
+        'lon': graph.lon,
+        'offsets': graph.offsets,
+        'neighbors': graph.neighbors,
+        'weights': graph.weights,
+        'index_order': graph.spatial_index().order,
+        'index_axis': graph.spatial_index().axis
+    })
+    return graph
+
+def load_graph(data_file, cache_file=None, verbose=True):
+    '''
+    Load the road graph from its binary cache, compiling the cache first when it is missing or stale
+    '''
+    cache_file = cache_file or data_file + '.graph'
+    sections = read_sections(cache_file, data_file)
+    if sections is None:
+        try:
+            graph = compile_graph(data_file, cache_file)
+        except OSError:
+            # Read-only data directory: answer from the parsed text and skip the cache
+            graph = parse_city_data_file(data_file, verbose=False)
+    else:
+        names = sections['names'].tobytes().decode()
+        graph = RoadGraph(
+            names.split('\n') if names else [],
+            sections['lat'],
+            sections['lon'],
+            sections['offsets'],
+            sections['neighbors'],
+            sections['weights']
+        )
+        graph.index = CityIndex(graph, sections['index_order'], sections['index_axis'])
+    if verbose:
+        sys.stdout.write("Reading data .... Done\n")
+        sys.stdout.write(f'Number of cities: {len(graph)}\n')
+    return graph
+
+def parse_coordinates(text):
+    lat, lon = text.split(',')
+    return float(lat), float(lon)
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='A* route planner over a city/road data file')
+    parser.add_argument('data_file', help='city and road distance file')
+    parser.add_argument('--compile', action='store_true', help='only (re)build the binary graph cache')
+    parser.add_argument('--batch', metavar='QUERIES', help='file of "start, end" lines to answer, - for stdin')
+    parser.add_argument('--output', default='-', help='where batch results are written as JSONL (default stdout)')
+    parser.add_argument('--workers', type=int, default=1, help='processes used to answer batch queries')
+    parser.add_argument('--algorithm', choices=['astar', 'bidirectional', 'ch'], default='astar',
+                        help='search used to answer queries')
+    parser.add_argument('--landmarks', type=int, default=0, metavar='K',
+                        help='use K ALT landmarks on top of the great-circle heuristic')
+    parser.add_argument('--from', dest='from_coordinates', type=parse_coordinates, metavar='LAT,LON',
+                        help='route from the city nearest to this point (use with --to)')
+    parser.add_argument('--to', dest='to_coordinates', type=parse_coordinates, metavar='LAT,LON',
+                        help='route to the city nearest to this point (use with --from)')
+    parser.add_argument('--nearest', type=parse_coordinates, metavar='LAT,LON',
+                        help='list the cities nearest to this point')
+    parser.add_argument('--count', type=int, default=5, help='how many cities --nearest lists')
+    parser.add_argument('--radius', type=float, metavar='MILES',
+                        help='make --nearest list every city within this distance instead')
+    parser.add_argument('--matrix', nargs=2, metavar=('SOURCES', 'TARGETS'),
+                        help='files of city names, one per line; writes the distance matrix to --output')
+    parser.add_argument('--stats', action='store_true',
+                        help='report search counters and load/search/reconstruct timings as JSON')
+    parser.add_argument('--benchmark', type=int, metavar='N',
+                        help='time contraction hierarchy preprocessing and N random queries against A*')
+    return parser.parse_args(argv)
 
 def main():
-    filename = sys.argv[1]
-    city_location, city_distance = parse_city_data_file(filename)
-    start_point, end_point = get_user_input(city_location)
-    calculate_optimal_path((0,0), start_point, end_point, city_distance, city_location)
+    args = parse_arguments(sys.argv[1:])
+    if args.compile:
+        graph = compile_graph(args.data_file)
+        sys.stdout.write(f'Compiled {len(graph)} cities into {args.data_file}.graph\n')
+        return
+
+    if args.benchmark:
+        graph = load_graph(args.data_file, verbose=False)
+        sys.stdout.write(json.dumps(benchmark_routing(graph, args.data_file, args.benchmark), indent=2) + '\n')
+        return
+
+    if args.nearest:
+        graph = load_graph(args.data_file, verbose=False)
+        index = graph.spatial_index()
+        lat, lon = args.nearest
+        found = index.within(lat, lon, args.radius) if args.radius is not None else index.nearest(lat, lon, args.count)
+        for city, miles in found:
+            sys.stdout.write(f'{graph.names[city]} {miles:.1f} miles\n')
+        return
+
+    stats = SearchStats() if args.stats else None
+    if args.from_coordinates or args.to_coordinates:
+        if not (args.from_coordinates and args.to_coordinates):
+            sys.exit('--from and --to must be given together')
+        with timed_phase(stats, 'load'):
+            graph = load_graph(args.data_file)
+            options = load_search_options(graph, args.data_file, args.algorithm, args.landmarks)
+        route_from_coordinates(args.from_coordinates, args.to_coordinates, graph, stats=stats, **options)
+        if stats is not None:
+            sys.stdout.write(f'Search stats: {json.dumps(stats.to_dict())}\n')
+        return
+
+    if args.matrix:
+        graph = load_graph(args.data_file, verbose=False)
+        source_points, target_points = read_city_list(args.matrix[0]), read_city_list(args.matrix[1])
+        hierarchy = load_hierarchy(graph, args.data_file) if args.algorithm == 'ch' else None
+        matrix = distance_matrix(graph, source_points, target_points, hierarchy, args.workers, args.data_file)
+        write_matrix(matrix, source_points, target_points, args.output)
+        return
+
+    if args.batch:
+        with timed_phase(stats, 'load'):
+            graph = load_graph(args.data_file, verbose=False)
+        run_batch(graph, args.batch, args.output, args.workers, args.data_file, stats,
+                  algorithm=args.algorithm, landmark_count=args.landmarks)
+        if stats is not None:
+            # stdout may be carrying the JSONL results, so the summary goes to stderr
+            sys.stderr.write(json.dumps(stats.to_dict()) + '\n')
+        return
+
+    with timed_phase(stats, 'load'):
+        graph = load_graph(args.data_file)
+        options = load_search_options(graph, args.data_file, args.algorithm, args.landmarks)
+    start_point, end_point = get_user_input(graph)
+    find_route(start_point, end_point, graph, stats=stats, **options)
+    if stats is not None:
+        sys.stdout.write(f'Search stats: {json.dumps(stats.to_dict())}\n')
 
-main()
-    
+if __name__ == '__main__':
+    main()
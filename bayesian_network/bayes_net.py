@@ -1,9 +1,15 @@
 from turtle import update
+from collections import OrderedDict
+from functools import reduce
+from itertools import combinations, islice, product, takewhile
+import multiprocessing
+import argparse
 import numpy as np
+import json
+import time
 import sys
 import re
 
-global edict
 class ProbDist:
     def __init__(self, var_name='?', freq=None):
         self.prob = {}
@@ -44,72 +50,536 @@ class Node:
         self.conditional_probability = conditional_probability
         self.children = []
 
-    def calculate_probability(self, value, event):
-        if isinstance(event, tuple) and len(event) == len(self.parents):
-            cond_prob = event
-        else:
-            cond_prob= tuple([event[var] for var in self.parents])
-        
-        update_index_val = int(value) - 1
-        if isinstance(self.conditional_probability, list):
-            if int(value) >= 4:
-                new_val = 1 - sum(self.conditional_probability)
-                self.conditional_probability.append(new_val)
-                ptrue = self.conditional_probability[update_index_val]
+    def table(self, domain, parent_domains):
+        '''
+        The CPT as an array over (parents..., variable). A single probability is P(first value), and a
+        row with one entry short of the domain is completed with 1 - sum
+        '''
+        values = np.empty([len(d) for d in parent_domains] + [len(domain)])
+        for parent_values in product(*[range(len(d)) for d in parent_domains]):
+            key = tuple(d[i] for d, i in zip(parent_domains, parent_values))
+            if isinstance(self.conditional_probability, list):
+                row = list(self.conditional_probability)
+            elif isinstance(self.conditional_probability[key], list):
+                row = list(self.conditional_probability[key])
             else:
-                ptrue = self.conditional_probability[update_index_val]
-        elif isinstance(self.conditional_probability[cond_prob], list):
-            ptrue = self.conditional_probability[cond_prob][update_index_val]
-        else:
-            ptrue = self.conditional_probability[cond_prob]
-                
-        return ptrue if value else 1 - ptrue
+                row = [self.conditional_probability[key]]
+            if len(row) == len(domain) - 1:
+                row.append(1 - sum(row))
+            if len(row) != len(domain):
+                raise ValueError('{} has {} probabilities for {} values'.format(self.variable, len(row), len(domain)))
+            values[parent_values] = row
+        return values
 
-class BayesNetwork:
+class Factor:
+    '''
+    Table over a tuple of variables: axis k of values is indexed by the positions of the
+    domain values of variables[k]
+    '''
+    def __init__(self, variables, values):
+        self.variables = tuple(variables)
+        self.values = np.asarray(values, dtype=float)
+
+    def expand(self, variables):
+        # Line the axes up with variables, adding a length-1 axis for every variable not in this factor
+        order = sorted(range(len(self.variables)), key=lambda k: variables.index(self.variables[k]))
+        shape = [self.values.shape[self.variables.index(v)] if v in self.variables else 1 for v in variables]
+        return self.values.transpose(order).reshape(shape)
+
+    def multiply(self, other):
+        variables = self.variables + tuple(v for v in other.variables if v not in self.variables)
+        return Factor(variables, self.expand(variables) * other.expand(variables))
 
-    def __init__(self, node_properties=None):
+    def sum_out(self, var):
+        axis = self.variables.index(var)
+        return Factor(self.variables[:axis] + self.variables[axis + 1:], self.values.sum(axis=axis))
+
+    def restrict(self, var, value_index):
+        axis = self.variables.index(var)
+        return Factor(self.variables[:axis] + self.variables[axis + 1:], np.take(self.values, value_index, axis=axis))
+
+    def project(self, variables):
+        # Sum out every variable not in variables
+        axes = tuple(k for k, v in enumerate(self.variables) if v not in variables)
+        return Factor([v for v in self.variables if v in variables], self.values.sum(axis=axes))
+
+class BayesNetwork:
+    '''
+    Nodes are kept in insertion order and addressed by integer index. compile() builds what the inference
+    code works on: parent index arrays, cardinalities, value -> index maps, a topological order and the
+    CPTs as contiguous arrays. Domains come from the network file header; variables without one are boolean.
+    '''
+    def __init__(self, node_properties=None, domains=None):
         self.nodes = []
         self.variables = []
+        self.index = {}
+        self.domains = {var: list(values) for var, values in (domains or {}).items()}
+        self.compiled = False
         node_properties = node_properties or []
         for prop in node_properties:
             self.add_node(prop)
-    
+
     def add_node(self, node_prop):
         node = Node(*node_prop)
+        self.index[node.variable] = len(self.nodes)
         self.nodes.append(node)
         self.variables.append(node.variable)
-        for parent in node.parents:
-            if self.curr_node(parent).children:
-                self.curr_node(parent).children.append(node)
+        self.compiled = False
 
     def curr_node(self, variable):
-        for node in self.nodes:
-            if node.variable == variable:
-                return node
+        return self.nodes[self.index[variable]]
 
     def domain_values(self, var):
-        if var in ['Quality', 'Kindness', 'Recommendation']:
-            return ['1', '2', '3', '4', '5']
-        else:
-            return [True, False]
+        return self.domains.get(var) or [True, False]
+
+    def compile(self):
+        if self.compiled:
+            return self
+        domains = [self.domain_values(var) for var in self.variables]
+        self.cardinalities = np.array([len(domain) for domain in domains], dtype=np.intp)
+        self.value_indices = [{value: k for k, value in enumerate(domain)} for domain in domains]
+        self.parent_indices = [np.array([self.index[parent] for parent in node.parents], dtype=np.intp)
+                               for node in self.nodes]
+        for node in self.nodes:
+            node.children = []
+        for node in self.nodes:
+            for parent in node.parents:
+                self.curr_node(parent).children.append(node)
+
+        order = []
+        placed = np.zeros(len(self.nodes), dtype=bool)
+        pending = list(range(len(self.nodes)))
+        while pending:
+            ready = [k for k in pending if placed[self.parent_indices[k]].all()]
+            if not ready:
+                raise ValueError('network has a cycle through ' + ', '.join(self.variables[k] for k in pending))
+            order.extend(ready)
+            placed[ready] = True
+            pending = [k for k in pending if not placed[k]]
+        self.order = np.array(order, dtype=np.intp)
+
+        self.cpts = [np.ascontiguousarray(node.table(domains[k], [domains[p] for p in self.parent_indices[k]]))
+                     for k, node in enumerate(self.nodes)]
+        self.compiled = True
+        return self
+
+    def value_index(self, var, value):
+        self.compile()
+        return self.value_indices[self.index[var]][value]
+
+    def probability(self, var, value, event):
+        '''
+        P(var = value | parents as given in event), read from the compiled CPT
+        '''
+        self.compile()
+        k = self.index[var]
+        row = tuple(self.value_indices[p][event[self.variables[p]]] for p in self.parent_indices[k])
+        return float(self.cpts[k][row + (self.value_indices[k][value],)])
+
+    def factor(self, var):
+        '''
+        CPT of var as a dense Factor over (parents..., var)
+        '''
+        self.compile()
+        k = self.index[var]
+        return Factor(self.nodes[k].parents + [var], self.cpts[k])
+
+    def topological_order(self):
+        self.compile()
+        return [self.variables[k] for k in self.order]
+
+    def ancestors(self, variables):
+        self.compile()
+        result = np.zeros(len(self.nodes), dtype=bool)
+        pending = [self.index[var] for var in variables]
+        while pending:
+            k = pending.pop()
+            if not result[k]:
+                result[k] = True
+                pending.extend(self.parent_indices[k].tolist())
+        return {self.variables[k] for k in np.flatnonzero(result)}
 
 def enumeration_ask(X, e, bayes_net):
     Q = ProbDist(X)
     for idx in bayes_net.domain_values(X):
-        Q[idx] = enumerate_all(bayes_net.variables, {**e, X: idx}, bayes_net)
+        Q[idx] = enumerate_all(bayes_net.topological_order(), {**e, X: idx}, bayes_net)
     return Q.normalize()
 
 def enumerate_all(variables, e, bayes_net):
     if not variables:
         return 1.0
     V = variables[0]
-    curr_node = bayes_net.curr_node(V)
     if V in e:
-        return curr_node.calculate_probability(e[V], e) * enumerate_all(variables[1:], e, bayes_net)
+        return bayes_net.probability(V, e[V], e) * enumerate_all(variables[1:], e, bayes_net)
     else:
-        return sum(curr_node.calculate_probability(y, e) * enumerate_all(variables[1:], {**e, V: y}, bayes_net)
+        return sum(bayes_net.probability(V, y, e) * enumerate_all(variables[1:], {**e, V: y}, bayes_net)
                    for y in bayes_net.domain_values(V))
 
+def elimination_order(factors, hidden, heuristic='min-fill', cliques=None):
+    '''
+    Greedy elimination order over the interaction graph of factors: repeatedly pick the hidden variable
+    whose elimination adds the fewest fill-in edges ('min-fill') or has the fewest neighbors ('min-degree').
+    If cliques is a list, the clique formed by each eliminated variable and its neighbors is appended to it
+    '''
+    neighbors = {}
+    for f in factors:
+        for var in f.variables:
+            neighbors.setdefault(var, set()).update(v for v in f.variables if v != var)
+
+    def cost(var):
+        adjacent = neighbors[var]
+        if heuristic == 'min-degree':
+            return len(adjacent)
+        return sum(1 for a, b in combinations(adjacent, 2) if b not in neighbors[a])
+
+    order = []
+    remaining = set(hidden)
+    while remaining:
+        var = min(sorted(remaining), key=lambda v: (cost(v), len(neighbors[v])))
+        order.append(var)
+        remaining.remove(var)
+        adjacent = neighbors.pop(var)
+        if cliques is not None:
+            cliques.append(frozenset(adjacent | {var}))
+        for other in adjacent:
+            neighbors[other].update(adjacent - {other})
+            neighbors[other].discard(var)
+    return order
+
+def elimination_ask(X, e, bayes_net, heuristic='min-fill'):
+    '''
+    Exact inference by variable elimination. Only ancestors of the query and evidence matter; their CPT
+    factors are restricted to the evidence, and hidden variables are summed out one at a time
+    '''
+    e = {var: value for var, value in e.items() if var != X}
+    relevant = bayes_net.ancestors([X] + list(e))
+    factors = []
+    for var in bayes_net.variables:
+        if var in relevant:
+            f = bayes_net.factor(var)
+            for evidence_var in f.variables:
+                if evidence_var in e:
+                    f = f.restrict(evidence_var, bayes_net.value_index(evidence_var, e[evidence_var]))
+            factors.append(f)
+
+    hidden = relevant - set(e) - {X}
+    for var in elimination_order(factors, hidden, heuristic):
+        related = [f for f in factors if var in f.variables]
+        factors = [f for f in factors if var not in f.variables]
+        factors.append(reduce(Factor.multiply, related).sum_out(var))
+
+    result = reduce(Factor.multiply, factors)
+    Q = ProbDist(X)
+    for value, p in zip(bayes_net.domain_values(X), result.expand((X,)).tolist()):
+        Q[value] = p
+    return Q.normalize()
+
+def canonical_evidence(e):
+    # Evidence as a hashable key that does not depend on the order it was given in
+    return tuple(sorted(e.items()))
+
+class JunctionTree:
+    '''
+    The network compiled once into a tree of cliques. Evidence is entered as indicator factors, one
+    collect and one distribute pass of messages calibrate every clique, and then the posterior of any
+    variable is read off the smallest clique containing it. Calibrations are kept in an LRU cache keyed
+    by the evidence, so repeated evidence sets cost no message passing at all.
+    '''
+    def __init__(self, bayes_net, heuristic='min-fill', cache_size=128):
+        self.bayes_net = bayes_net
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        factors = [bayes_net.factor(var) for var in bayes_net.variables]
+
+        # Triangulate by eliminating every variable, and keep the maximal cliques
+        eliminated = []
+        elimination_order(factors, bayes_net.variables, heuristic, eliminated)
+        maximal = []
+        for clique in sorted(set(eliminated), key=len, reverse=True):
+            if not any(clique <= other for other in maximal):
+                maximal.append(clique)
+        self.cliques = [tuple(v for v in bayes_net.variables if v in clique) for clique in maximal]
+
+        # Maximum spanning tree on separator sizes (Kruskal) gives the running intersection property
+        self.neighbors = [[] for _ in self.cliques]
+        component = list(range(len(self.cliques)))
+
+        def find(k):
+            while component[k] != k:
+                component[k] = component[component[k]]
+                k = component[k]
+            return k
+
+        candidates = sorted(
+            ((len(set(a) & set(b)), i, j) for (i, a), (j, b) in combinations(enumerate(self.cliques), 2)),
+            reverse=True
+        )
+        for _, i, j in candidates:
+            if find(i) != find(j):
+                component[find(i)] = find(j)
+                self.neighbors[i].append(j)
+                self.neighbors[j].append(i)
+
+        # Every CPT goes into one clique covering its scope
+        self.potentials = []
+        for clique in self.cliques:
+            self.potentials.append(np.ones([len(bayes_net.domain_values(v)) for v in clique]))
+        for f in factors:
+            home = min((k for k, clique in enumerate(self.cliques) if set(f.variables) <= set(clique)),
+                       key=lambda k: len(self.cliques[k]))
+            self.potentials[home] = self.potentials[home] * f.expand(self.cliques[home])
+        self.home = {var: min((k for k, clique in enumerate(self.cliques) if var in clique),
+                              key=lambda k: len(self.cliques[k]))
+                     for var in bayes_net.variables}
+
+        # Collect order: parents before children from clique 0, so reversed it visits children first
+        self.parent = [None] * len(self.cliques)
+        self.order = []
+        for root in range(len(self.cliques)):
+            if root in self.order:
+                continue
+            stack = [root]
+            while stack:
+                k = stack.pop()
+                self.order.append(k)
+                for other in self.neighbors[k]:
+                    if other != self.parent[k]:
+                        self.parent[other] = k
+                        stack.append(other)
+
+    def message(self, beliefs, sender, receiver, messages):
+        clique = self.cliques[sender]
+        values = beliefs[sender]
+        for other in self.neighbors[sender]:
+            if other != receiver:
+                values = values * messages[other, sender].expand(clique)
+        separator = set(clique) & set(self.cliques[receiver])
+        result = Factor(clique, values).project(separator)
+        total = result.values.sum()
+        # Scale messages to sum to one so long chains do not underflow; posteriors are normalized anyway
+        return Factor(result.variables, result.values / total) if total > 0 else result
+
+    def calibrate(self, e):
+        '''
+        Clique beliefs under evidence e, from the cache when the same evidence was seen before
+        '''
+        key = canonical_evidence(e)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        beliefs = list(self.potentials)
+        for var, value in e.items():
+            indicator = np.zeros(len(self.bayes_net.domain_values(var)))
+            indicator[self.bayes_net.value_index(var, value)] = 1.0
+            home = self.home[var]
+            beliefs[home] = beliefs[home] * Factor((var,), indicator).expand(self.cliques[home])
+
+        messages = {}
+        for k in reversed(self.order):
+            if self.parent[k] is not None:
+                messages[k, self.parent[k]] = self.message(beliefs, k, self.parent[k], messages)
+        for k in self.order:
+            if self.parent[k] is not None:
+                messages[self.parent[k], k] = self.message(beliefs, self.parent[k], k, messages)
+
+        calibrated = []
+        for k, clique in enumerate(self.cliques):
+            values = beliefs[k]
+            for other in self.neighbors[k]:
+                values = values * messages[other, k].expand(clique)
+            calibrated.append(values)
+
+        self.cache[key] = calibrated
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return calibrated
+
+    def query(self, X, e):
+        e = {var: value for var, value in e.items() if var != X}
+        beliefs = self.calibrate(e)
+        home = self.home[X]
+        marginal = Factor(self.cliques[home], beliefs[home]).project({X})
+        Q = ProbDist(X)
+        for value, p in zip(self.bayes_net.domain_values(X), marginal.values.tolist()):
+            Q[value] = p
+        return Q.normalize()
+
+    def posteriors(self, e):
+        '''
+        ProbDist of every variable not in e, all from a single calibration
+        '''
+        return {var: self.query(var, e) for var in self.bayes_net.variables if var not in e}
+
+class SampleEstimate:
+    '''
+    Posterior estimated by sampling, with the standard error of each probability
+    '''
+    def __init__(self, distribution, standard_error, samples, seconds):
+        self.distribution = distribution
+        self.standard_error = standard_error
+        self.samples = samples
+        self.seconds = seconds
+
+def sampling_tables(bayes_net):
+    '''
+    (variable, column, parent columns, CPT array) in topological order; a sample is one row of
+    value indices with the variable's network index as its column
+    '''
+    bayes_net.compile()
+    return [(bayes_net.variables[k], k, bayes_net.parent_indices[k], bayes_net.cpts[k]) for k in bayes_net.order]
+
+def conditional_rows(cpt, parent_columns, state):
+    # One row of P(var | parents) per sample
+    if len(parent_columns) == 0:
+        return np.broadcast_to(cpt, (len(state), len(cpt)))
+    return cpt[tuple(state[:, c] for c in parent_columns)]
+
+def draw(probabilities, generator):
+    cumulative = probabilities.cumsum(axis=1)
+    u = generator.random(len(probabilities))[:, None] * cumulative[:, -1:]
+    return np.minimum((u > cumulative).sum(axis=1), probabilities.shape[1] - 1)
+
+def weighted_samples(tables, evidence, size, generator):
+    '''
+    size samples drawn together in topological order, evidence variables clamped and their likelihood
+    multiplied into the weights. Returns the sampled states and weights
+    '''
+    state = np.zeros((size, len(tables)), dtype=np.intp)
+    weights = np.ones(size)
+    for var, column, parent_columns, cpt in tables:
+        rows = conditional_rows(cpt, parent_columns, state)
+        if var in evidence:
+            state[:, column] = evidence[var]
+            weights *= rows[:, evidence[var]]
+        else:
+            state[:, column] = draw(rows, generator)
+    return state, weights
+
+def _likelihood_weighting_batch(bayes_net, X, evidence, size, seed):
+    tables = sampling_tables(bayes_net)
+    x_column = bayes_net.index[X]
+    state, weights = weighted_samples(tables, evidence, size, np.random.default_rng(seed))
+    cardinality = len(bayes_net.domain_values(X))
+    indicator = np.eye(cardinality)[state[:, x_column]]
+    return weights @ indicator, (weights ** 2) @ indicator, weights.sum(), (weights ** 2).sum()
+
+def _gibbs_batch(bayes_net, X, evidence, size, seed, chains=32, burn_in=50):
+    '''
+    Run chains Gibbs samplers side by side for burn_in + size sweeps and return, per chain, the fraction
+    of recorded sweeps spent in each value of X. Chains start from likelihood weighted samples resampled
+    by weight, so they begin in states consistent with the evidence
+    '''
+    generator = np.random.default_rng(seed)
+    tables = sampling_tables(bayes_net)
+    position = {var: k for k, (var, _, _, _) in enumerate(tables)}
+    children = {var: [child.variable for child in bayes_net.curr_node(var).children] for var, _, _, _ in tables}
+
+    starts, weights = weighted_samples(tables, evidence, chains * 8, generator)
+    if weights.sum() == 0:
+        raise ZeroDivisionError('evidence has probability zero')
+    state = starts[generator.choice(len(starts), size=chains, p=weights / weights.sum())]
+
+    x_column = bayes_net.index[X]
+    cardinality = len(bayes_net.domain_values(X))
+    counts = np.zeros((chains, cardinality))
+    hidden = [var for var, _, _, _ in tables if var not in evidence]
+    for sweep in range(burn_in + size):
+        for var in hidden:
+            _, column, parent_columns, cpt = tables[position[var]]
+            # P(var | Markov blanket) is P(var | parents) times P(child | its parents) for every child
+            probabilities = np.array(conditional_rows(cpt, parent_columns, state))
+            for child in children[var]:
+                _, child_column, child_parents, child_cpt = tables[position[child]]
+                for value in range(probabilities.shape[1]):
+                    candidate = state.copy()
+                    candidate[:, column] = value
+                    probabilities[:, value] *= conditional_rows(child_cpt, child_parents, candidate)[
+                        np.arange(chains), state[:, child_column]]
+            state[:, column] = draw(probabilities, generator)
+        if sweep >= burn_in:
+            counts[np.arange(chains), state[:, x_column]] += 1
+    return counts / size
+
+_worker_network = None
+
+def _init_sampling_worker(bayes_net):
+    global _worker_network
+    _worker_network = bayes_net
+
+def _sampling_worker(task):
+    method, X, evidence, size, seed = task
+    if method == 'gibbs':
+        return _gibbs_batch(_worker_network, X, evidence, size, seed)
+    return _likelihood_weighting_batch(_worker_network, X, evidence, size, seed)
+
+def sampling_ask(X, e, bayes_net, method='likelihood', samples=None, precision=None, time_budget=None,
+                 seed=None, batch_size=None, workers=1):
+    '''
+    Approximate P(X | e) with likelihood weighting ('likelihood') or Gibbs sampling ('gibbs'). Samples are
+    drawn in rounds of one batch per worker, each with its own seed spawned from seed, until samples have
+    been drawn, every standard error is at most precision, or time_budget seconds have passed, whichever
+    comes first (100000 samples if none is given). For Gibbs sampling every sweep of every chain counts as
+    a sample, and the standard error comes from the spread between independent chains.
+    '''
+    if samples is None and precision is None and time_budget is None:
+        samples = 100000
+    if batch_size is None:
+        batch_size = 10000 if method == 'likelihood' else 200
+    domain = bayes_net.domain_values(X)
+    evidence = {var: bayes_net.value_index(var, value) for var, value in e.items() if var != X}
+    seeds = np.random.SeedSequence(seed)
+    start = time.perf_counter()
+
+    weighted, weighted_squares, total, total_squares = np.zeros(len(domain)), np.zeros(len(domain)), 0.0, 0.0
+    chain_estimates = []
+    drawn = 0
+    pool = multiprocessing.Pool(workers, _init_sampling_worker, (bayes_net,)) if workers > 1 else None
+    try:
+        while True:
+            tasks = [(method, X, evidence, batch_size, child.generate_state(4)) for child in seeds.spawn(workers)]
+            if pool is None:
+                _init_sampling_worker(bayes_net)
+                results = map(_sampling_worker, tasks)
+            else:
+                results = pool.map(_sampling_worker, tasks)
+            for result in results:
+                if method == 'gibbs':
+                    chain_estimates.append(result)
+                    drawn += batch_size * len(result)
+                else:
+                    drawn += batch_size
+                    weighted += result[0]
+                    weighted_squares += result[1]
+                    total += result[2]
+                    total_squares += result[3]
+
+            if method == 'gibbs':
+                estimates = np.concatenate(chain_estimates)
+                probabilities = estimates.mean(axis=0)
+                standard_error = estimates.std(axis=0, ddof=1) / np.sqrt(len(estimates))
+            else:
+                if total == 0:
+                    raise ZeroDivisionError('evidence has probability zero')
+                probabilities = weighted / total
+                # Delta method for the ratio estimator sum(w * [x]) / sum(w)
+                variance = weighted_squares * (1 - 2 * probabilities) + probabilities ** 2 * total_squares
+                standard_error = np.sqrt(np.maximum(variance, 0)) / total
+
+            elapsed = time.perf_counter() - start
+            if ((samples is not None and drawn >= samples)
+                    or (precision is not None and standard_error.max() <= precision)
+                    or (time_budget is not None and elapsed >= time_budget)):
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    Q = ProbDist(X)
+    for value, p in zip(domain, probabilities.tolist()):
+        Q[value] = p
+    return SampleEstimate(Q, dict(zip(domain, standard_error.tolist())), drawn, elapsed)
+
 
 def parse_data_from_input(filename):
     bayes_net = {}
@@ -149,15 +619,15 @@ def parse_data_from_input(filename):
                 if prob[i] == val:
                     curr_key = prob[i]
                     if prob[i+1] != prob[i] and \
-                    ('T' or 'F') not in prob[i+1]:
+                    not bayes_net[prob[i]].get('parents'):
                         if ' ' not in prob[i+1]:
                             bayes_net[prob[i]]['prob'] = float(prob[i+1])
                         else:
                             prob_to_list = prob[i+1].split(' ')
                             prob_to_list = [float(x) for x in prob_to_list]
-                            bayes_net[prob[i]] = {
+                            bayes_net[prob[i]].update({
                                 'prob': prob_to_list
-                            }
+                            })
     
                 elif curr_key != prob[i]:
                     curr_condition = prob[i].split(' ')
@@ -180,9 +650,22 @@ def parse_data_from_input(filename):
                         })
     return bayes_net
 
+def declared_domains(bh):
+    '''
+    Domain of every variable as listed in the file header, with T and F read as booleans
+    '''
+    bool_parser = {
+        'T': True,
+        'F': False
+    }
+    return {var: [bool_parser.get(value, value) for value in val['domains']]
+            for var, val in bh.items() if val.get('domains')}
+
 def restructure_data_format(bh, is_book=False, inputs=None):
     inputs = {} if inputs is None else inputs
     result = []
+    # Work on a copy so the parsed file can be restructured again, e.g. with other inputs
+    bh = {var: dict(val) for var, val in bh.items()}
 
     bool_parser = {
         'T': True,
@@ -195,9 +678,7 @@ def restructure_data_format(bh, is_book=False, inputs=None):
             if val not in bh[key]['prob']:
                 for i in bh[key]['prob'].values():
                     total += float(i)
-                bh[key]['prob'].update({
-                    val: 1 - total
-                }) 
+                bh[key]['prob'] = {**bh[key]['prob'], val: 1 - total}
 
     list_of_keys = bh.keys()
 
@@ -232,7 +713,7 @@ def restructure_data_format(bh, is_book=False, inputs=None):
                         res.append(tuple(prob))
                 curr_prob_keys = res
             else:
-                curr_prob_keys = [tuple(bool_parser[i] for i in prob) for prob in curr_prob_keys]
+                curr_prob_keys = [tuple(bool_parser.get(i, i) for i in prob) for prob in curr_prob_keys]
             bh[val]['conditional_prob'] = dict(zip(curr_prob_keys, curr_prob_values))
 
             curr_list.append(bh[val]['conditional_prob'])
@@ -241,54 +722,187 @@ def restructure_data_format(bh, is_book=False, inputs=None):
     
     return result
 
-def get_user_input(bayes_input):
+def parse_query(query_input):
     '''
-    Prompt messages asking users
+    Split a query line 'X | A=a, B=b' (or just 'X') into X and an evidence dict, with T and F read as
+    booleans
     '''
     bool_parser = {
         'T': True,
         'F': False
     }
+    match = re.match(r'(.*)\|(.*\=.*)', query_input)
+    if match:
+        X = match.group(1).strip()
+        e = {}
+        for evidence in match.group(2).replace(' ', '').split(','):
+            var, value = evidence.split('=')
+            e[var] = bool_parser.get(value, value)
+    else:
+        X = query_input.strip()
+        e = {}
+    return X, e
+
+def format_value(value):
+    # Back to the notation of the network file
+    if value is True:
+        return 'T'
+    if value is False:
+        return 'F'
+    return str(value)
+
+class PosteriorCache:
+    '''
+    Bounded LRU of answers keyed by (query variable, canonical evidence)
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, X, e):
+        key = (X, canonical_evidence(e))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, X, e, answer):
+        self.entries[X, canonical_evidence(e)] = answer
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+def answer_queries(queries, bayes_net, junction_tree=None, method='exact', cache=None, group_size=1000,
+                   **sampling_options):
+    '''
+    Answer (X, e) pairs, yielding (X, e, answer) in input order. answer is a ProbDist for method 'exact' and
+    a SampleEstimate otherwise, or the exception raised for that query. Queries are taken group_size at a
+    time and those sharing evidence are answered together, so each evidence set is calibrated once
+    '''
+    if method == 'exact' and junction_tree is None:
+        junction_tree = JunctionTree(bayes_net)
+    cache = PosteriorCache() if cache is None else cache
+    queries = iter(queries)
+    while True:
+        group = list(islice(queries, group_size))
+        if not group:
+            return
+        by_evidence = OrderedDict()
+        for position, (X, e) in enumerate(group):
+            e = {var: value for var, value in e.items() if var != X}
+            by_evidence.setdefault(canonical_evidence(e), []).append(position)
+
+        answers = [None] * len(group)
+        for positions in by_evidence.values():
+            for position in positions:
+                X, e = group[position]
+                e = {var: value for var, value in e.items() if var != X}
+                answer = cache.get(X, e)
+                if answer is None:
+                    try:
+                        if method == 'exact':
+                            answer = junction_tree.query(X, e)
+                        else:
+                            answer = sampling_ask(X, e, bayes_net, method, **sampling_options)
+                    except (KeyError, ValueError, ZeroDivisionError) as error:
+                        answer = error
+                    cache.put(X, e, answer)
+                answers[position] = answer
+        for (X, e), answer in zip(group, answers):
+            yield X, e, answer
+
+def run_batch(bayes_net, query_file, output_file, method='exact', cache_size=1024, group_size=1000,
+              **sampling_options):
+    '''
+    Read one query per line from query_file until EOF or 'quit' and write one JSON object per query to
+    output_file. Results are written after every group_size queries, so another process can stream queries
+    in; a smaller group_size answers sooner but shares fewer calibrations. Lines that cannot be parsed or
+    name unknown variables get an 'error' field instead of a distribution
+    '''
+    junction_tree = JunctionTree(bayes_net) if method == 'exact' else None
+    cache = PosteriorCache(cache_size)
+    lines = (line.strip() for line in query_file)
+    lines = takewhile(lambda line: line != 'quit', (line for line in lines if line))
+    while True:
+        chunk = list(islice(lines, group_size))
+        if not chunk:
+            return cache
+        parsed = []
+        for line in chunk:
+            try:
+                parsed.append(parse_query(line))
+            except ValueError as error:
+                parsed.append(error)
+        answers = answer_queries([query for query in parsed if not isinstance(query, Exception)], bayes_net,
+                                 junction_tree, method, cache, group_size, **sampling_options)
+
+        for line, query in zip(chunk, parsed):
+            record = {'query': line}
+            if isinstance(query, Exception):
+                record['error'] = 'cannot parse query: {}'.format(query)
+            else:
+                X, e, answer = next(answers)
+                record['variable'] = X
+                record['evidence'] = {var: format_value(value) for var, value in e.items()}
+                if isinstance(answer, Exception):
+                    record['error'] = '{}: {}'.format(type(answer).__name__, answer)
+                elif isinstance(answer, SampleEstimate):
+                    record['distribution'] = {format_value(v): p for v, p in answer.distribution.prob.items()}
+                    record['standard_error'] = {format_value(v): se for v, se in answer.standard_error.items()}
+                else:
+                    record['distribution'] = {format_value(v): p for v, p in answer.prob.items()}
+            output_file.write(json.dumps(record) + '\n')
+        output_file.flush()
+
+def get_user_input(bayes_input, method='exact', domains=None, precision=0.005, time_budget=10):
+    '''
+    Prompt messages asking users. method 'likelihood' or 'gibbs' answers by sampling, stopping at the given
+    precision or time_budget, and also prints the standard error of every probability. domains maps
+    variables to the values declared in the file header
+    '''
+    # The network and its junction tree are compiled once and reused by every query
+    bayes_net = BayesNetwork(bayes_input, domains).compile()
+    junction_tree = JunctionTree(bayes_net)
+    cache = PosteriorCache()
     query_input = ''
     while query_input != 'quit':
         query_input = input("Enter your query: ")
         if query_input == 'quit':
             sys.exit("Goodbye.\n")
         else:
-            match = re.match(r'(.*)\|(.*\=.*)', query_input)
-            global edict
-
-            if match:
-                X = match.group(1).strip()
-                e = match.group(2).strip().replace(' ', '')
-                if ',' in e:
-                    result = []
-                    e_split = e.split(',')
-                    for evidence in e_split:
-                        e_split = evidence.split('=')
-                        result += e_split
-                    e = result
-                else:
-                    e = e.split('=')
-                it = iter(e)
-                edict = dict(zip(it, it))
-                for k, v in edict.items():
-                    if v == 'T' or v == 'F':
-                        edict[k] = bool_parser[v]
-
+            X, e = parse_query(query_input)
+            (_, _, answer), = answer_queries([(X, e)], bayes_net, junction_tree, method, cache,
+                                             precision=precision, time_budget=time_budget)
+            if isinstance(answer, Exception):
+                raise answer
+            if method == 'exact':
+                print(', '.join([('P({}): ' + '{:.3g}').format(v, p) for (v, p) in sorted(answer.prob.items())]))
             else:
-                match = re.match(r'(.*)', query_input)
-                if match:
-                    X = match.group(1).strip()
-                e = []
-                edict = {}
+                print(', '.join([('P({}): ' + '{:.3g} ± {:.2g}').format(v, p, answer.standard_error[v])
+                                 for (v, p) in sorted(answer.distribution.prob.items())]))
 
-            bayes_net = BayesNetwork(bayes_input)
-            solution = enumeration_ask(X, edict, bayes_net)
-            print(', '.join([('P({}): ' + '{:.3g}').format(v, p) for (v, p) in sorted(solution.prob.items())]))
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Answer queries on a Bayesian network')
+    parser.add_argument('filename', help='network file')
+    parser.add_argument('method', nargs='?', default='exact', choices=['exact', 'likelihood', 'gibbs'],
+                        help='exact inference or sampling (default exact)')
+    parser.add_argument('--batch', metavar='FILE',
+                        help="answer the queries in FILE, one per line ('-' for stdin), as JSON lines")
+    parser.add_argument('--output', metavar='FILE', help='write batch results to FILE instead of stdout')
+    parser.add_argument('--cache-size', type=int, default=1024, help='answers kept in the LRU cache')
+    parser.add_argument('--group-size', type=int, default=1000,
+                        help='batch queries read before answering; those sharing evidence share one calibration')
+    parser.add_argument('--precision', type=float, default=0.005, help='target standard error when sampling')
+    parser.add_argument('--time-budget', type=float, default=10, help='seconds per sampled query')
+    return parser.parse_args()
 
 def main():
-    filename = sys.argv[1]
+    args = parse_arguments()
+    filename = args.filename
+    method = args.method
     is_book_file= None
 
     if 'books' in filename:
@@ -302,6 +916,20 @@ def main():
     else:
         bayes_input = restructure_data_format(bh)
 
-    get_user_input(bayes_input)
+    if args.batch:
+        bayes_net = BayesNetwork(bayes_input, declared_domains(bh)).compile()
+        query_file = sys.stdin if args.batch == '-' else open(args.batch)
+        output_file = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            run_batch(bayes_net, query_file, output_file, method, args.cache_size, args.group_size,
+                      precision=args.precision, time_budget=args.time_budget)
+        finally:
+            if query_file is not sys.stdin:
+                query_file.close()
+            if output_file is not sys.stdout:
+                output_file.close()
+    else:
+        get_user_input(bayes_input, method, declared_domains(bh), args.precision, args.time_budget)
 
-main()
+if __name__ == '__main__':
+    main()
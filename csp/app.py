@@ -1,118 +1,262 @@
+from collections import deque
+from itertools import islice
+import multiprocessing
+import argparse
+import random
+import time
 import sys
+import os
+
+class SearchLimitReached(Exception):
+    pass
+
+def luby(i):
+    '''
+    i-th term (from 1) of the Luby sequence 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, ...
+    '''
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    while i != (1 << k) - 1:
+        i -= (1 << (k - 1)) - 1
+        k = 1
+        while (1 << k) - 1 < i:
+            k += 1
+    return 1 << (k - 1)
 
-RECURSIVE_CALLS = 0
 class CSP():
 
-    def __init__(self, csp):
+    VALUE_ORDERS = ('lcv', 'alphabetical', 'random')
+    VARIABLE_ORDERS = ('mrv', 'domwdeg')
+
+    def __init__(self, csp, index=None, inference='mac', value_order='lcv', seed=None, variable_order='mrv'):
         self.csp = csp
+        self.index = WordIndex(csp.words) if index is None else index
+        self.inference = inference
+        self.value_order = value_order
+        self.variable_order = variable_order
+        # With a seed, ties between variables and between equally constraining words are broken at random
+        self.randomize = seed is not None
+        self.random = random.Random(seed)
+        # Each domain is a bitset over the word IDs of the index, so its size is a popcount and saving
+        # or restoring it is a single int
         self.domains = {}
-
+        # Domains as they were before each change, as (variable, domain) entries, so a failed branch can
+        # put them back
+        self.trail = []
+        self.used_words = set()
+        # IDs of the variables not in the current assignment, kept up to date by assign and unassign so
+        # variable selection only looks at those
+        self.unassigned = set(range(len(self.csp.variables)))
+
+        # Conflict learning for restarts: a weight per constraint, bumped whenever it wipes out a domain,
+        # and nogoods, sets of (variable ID, word) pairs that cannot all hold, indexed by each of their pairs
+        self.weights = {}
+        self.nogoods = {}
+        # Decisions on the current search path as (variable, word, words already refuted at that level)
+        self.decisions = []
+        self.failures = 0
+        self.fail_limit = None
+        self.restarts = 0
+        self.recursive_calls = 0
+        self.consistency_checks = 0
+        self.prunings = 0
+
+        # A slot can only ever hold words of its own length, so start from those
         for var in self.csp.variables:
-            self.domains[var] = self.csp.words.copy()
+            self.domains[var] = self.index.of_length(var.length)
 
     def revise(self, x, y):
         '''
-        Perform revision against each pair of (Xi, Xj) where both words matched and have an overlapping
+        Remove every word of Xi that has no supporting word in Xj, i.e. no different word with the same
+        letter at the overlapping cell. Supports are found with one bitset AND per letter of the alphabet
+        instead of comparing every pair of words.
         '''
         i, j = self.csp.intersects[x, y]
-        is_revised = False
-        for first_word in self.domains[x].copy():
-            is_matched = False
-            for second_word in self.domains[y]:
-                if len(first_word) > i and len(second_word) > j and first_word[i] == second_word[j] and first_word != second_word:
-                    is_matched = True
-                    break
-            if is_matched == False:
-                self.domains[x].remove(first_word)
-                is_revised = True
-        return is_revised
+        index = self.index
+        first_domain = self.domains[x]
+        second_domain = self.domains[y]
+        supported = 0
+        for letter, words_with_letter in index.letters_at(y.length, j).items():
+            supports = second_domain & words_with_letter
+            if supports:
+                candidates = index.matching(x.length, i, letter)
+                # A word cannot support itself, since all words in the grid must differ
+                if supports & (supports - 1) == 0:
+                    candidates &= ~supports
+                supported |= candidates
+        removed = first_domain & ~supported
+        if removed:
+            self.trail.append((x, first_domain))
+            self.domains[x] = first_domain & supported
+            self.prunings += removed.bit_count()
+            return True
+        return False
+
+    def domain_size(self, var):
+        return self.domains[var].bit_count()
+
+    def domain_words(self, var):
+        return self.index.words_in(self.domains[var])
+
+    def snapshot(self):
+        '''
+        Copy of every domain; cheap, since each one is a single int
+        '''
+        return dict(self.domains)
+
+    def restore(self, snapshot):
+        self.domains.update(snapshot)
+
+    def undo(self, mark):
+        '''
+        Put back every domain changed since the trail was at mark
+        '''
+        trail = self.trail
+        domains = self.domains
+        while len(trail) > mark:
+            variable, domain = trail.pop()
+            domains[variable] = domain
 
     def get_all_arcs_csp(self):
         arcs = []
-        for first_variable, second_variable in self.csp.intersects:
-            if self.csp.intersects[first_variable, second_variable] is not None:
+        for first_variable in self.csp.variables:
+            for second_variable, _, _ in self.csp.neighbors[first_variable.id]:
                 arcs.append((first_variable, second_variable))
         return arcs
 
     def arc_consistency_ac3(self, arcs=None):
-        while not arcs:
-            # Get a queue that contains all arcs in CSP
-            arcs = self.get_all_arcs_csp()
-                 
-        for i, j in arcs:
-            is_revised = self.revise(i ,j)
-            if is_revised:
-                if len(self.domains[i]) == 0:
+        '''
+        AC-3: revise arcs from a work queue and, whenever Xi loses words, put every arc (Xk, Xi) back on
+        the queue so the loss propagates until no domain changes. Returns False if a domain empties.
+        '''
+        queue = deque(self.get_all_arcs_csp() if arcs is None else arcs)
+        queued = set(queue)
+        while queue:
+            i, j = queue.popleft()
+            queued.discard((i, j))
+            if self.revise(i, j):
+                if self.domains[i] == 0:
+                    self.bump_weight(i, j)
                     return False
+                for k, _, _ in self.csp.neighbors[i.id]:
+                    if k != j and (k, i) not in queued:
+                        queue.append((k, i))
+                        queued.add((k, i))
         return True
 
+    def bump_weight(self, x, y):
+        constraint = (x.id, y.id) if x.id < y.id else (y.id, x.id)
+        self.weights[constraint] = self.weights.get(constraint, 1) + 1
+
+    def weighted_degree(self, var, assignment):
+        weighted_degree = 0
+        for var2, _, _ in self.csp.neighbors[var.id]:
+            if var2 not in assignment:
+                constraint = (var.id, var2.id) if var.id < var2.id else (var2.id, var.id)
+                weighted_degree += self.weights.get(constraint, 1)
+        return weighted_degree
+
     def select_unassigned_variable(self, assignment):
         '''
-        Check for the most constrained variable based on a word. Then check for most constraining variable if 
-        exists a ties between variables within the most constrained set
-        '''
-        fewest_legal_moves_set = set()
-        most_constrainted_variable = len(self.csp.words)
-        for word in self.csp.variables:
-            if word not in assignment:
-                if len(self.domains[word]) <= most_constrainted_variable:
-                    fewest_legal_moves_set.add(word)
-                    most_constrainted_variable = len(self.domains[word])
-                elif len(self.domains[word]) == most_constrainted_variable:
-                    fewest_legal_moves_set.add(word)
-
-        most_neighbors = 0
-        most_constraining_variable = set()
-
-        for word in fewest_legal_moves_set:
-            current_neighbors = len(self.csp.get_neighbors(word))
-            if current_neighbors > most_neighbors:
-                most_constraining_variable.add(word)
-                most_neighbors = current_neighbors
-            elif current_neighbors == most_neighbors:
-                most_constraining_variable.add(word)
-        
-        if len(fewest_legal_moves_set) == 1:
-            return fewest_legal_moves_set.pop()
-        else:
-            return most_constraining_variable.pop()
-        
-    
-    def is_consistent(self, assignment):
-        if len(assignment) != len(set(assignment.values())):
+        Check for the most constrained variable based on a word. Then check for most constraining variable if
+        exists a ties between variables within the most constrained set. With variable_order='domwdeg' pick
+        the smallest ratio of domain size to the weights of the constraints to unassigned neighbors instead.
+        '''
+        best_variable = None
+        best_key = None
+        for var_id in self.unassigned:
+            var = self.csp.variables[var_id]
+            if self.variable_order == 'domwdeg':
+                primary = (self.domain_size(var) / max(self.weighted_degree(var, assignment), 1), 0)
+            else:
+                primary = (self.domain_size(var), -self.csp.degree[var_id])
+            # The ID makes the choice independent of the iteration order of the set
+            key = primary + (self.random.random() if self.randomize else 0, var_id)
+            if best_key is None or key < best_key:
+                best_variable = var
+                best_key = key
+        return best_variable
+
+    def track_unassigned(self, assignment):
+        self.unassigned = {var.id for var in self.csp.variables if var not in assignment}
+
+    def is_consistent(self, var, word, assignment):
+        '''
+        Check a new assignment against the words already placed: it must fit the slot, must not repeat
+        a word used elsewhere and must agree with every assigned neighbor on their shared cell.
+        '''
+        self.consistency_checks += 1
+        if var.length != len(word) or word in self.used_words:
             return False
-        for var in assignment:
-            if var.length != len(assignment[var]):
-                return False      
-        for var in assignment:
-            first_word = assignment[var]
-            current_neighbors = self.csp.get_neighbors(var)
-            for var2 in current_neighbors:
-                if var2 in assignment:
-                    second_word = assignment[var2]
-                    i, j = self.csp.intersects[var, var2]
-                    # check if 2 words have same letter at the overlaping index
-                    if first_word[i] != second_word[j] or first_word == second_word:
-                        return False
+        for var2, i, j in self.csp.neighbors[var.id]:
+            if var2 in assignment:
+                if word[i] != assignment[var2][j]:
+                    return False
+        variables = self.csp.variables
+        for nogood in self.nogoods.get((var.id, word), ()):
+            if all(var_id == var.id or assignment.get(variables[var_id]) == other
+                   for var_id, other in nogood):
+                return False
         return True
-    
+
+    def assign(self, var, word, assignment):
+        '''
+        Place word in var and prune the domains of its unassigned neighbors, either by maintaining arc
+        consistency with AC-3 from those neighbors (inference='mac') or by plain forward checking.
+        Returns False on a wipe-out.
+        '''
+        assignment[var] = word
+        self.unassigned.discard(var.id)
+        self.used_words.add(word)
+        self.trail.append((var, self.domains[var]))
+        self.domains[var] = 1 << self.index.ids[word]
+
+        neighbors = [var2 for var2, _, _ in self.csp.neighbors[var.id] if var2 not in assignment]
+        if self.inference == 'mac':
+            return self.arc_consistency_ac3([(var2, var) for var2 in neighbors])
+        for var2 in neighbors:
+            if self.revise(var2, var) and self.domains[var2] == 0:
+                self.bump_weight(var2, var)
+                return False
+        return True
+
+    def unassign(self, var, assignment, mark):
+        '''
+        Remove var from the assignment and restore every domain pruned since the trail was at mark
+        '''
+        self.used_words.discard(assignment.pop(var))
+        self.unassigned.add(var.id)
+        self.undo(mark)
+
     def order_domain_values(self, var, assignment):
+        '''
+        Least constraining value: order the words of var by how many words they rule out in the domains
+        of unassigned neighbors. Letter counts per neighbor come from popcounts over the word index.
+        value_order='alphabetical' or 'random' skips the heuristic.
+        '''
+        words = self.domain_words(var)
+        if self.randomize or self.value_order == 'random':
+            self.random.shuffle(words)
+        if self.value_order != 'lcv':
+            return words
+
+        ruled_out = []
+        for variable, i, j in self.csp.neighbors[var.id]:
+            if variable not in assignment:
+                domain = self.domains[variable]
+                counts = {
+                    letter: (domain & words_with_letter).bit_count()
+                    for letter, words_with_letter in self.index.letters_at(variable.length, j).items()
+                }
+                ruled_out.append((i, domain.bit_count(), counts))
+
         result = {}
-        for word1 in self.domains[var]:
+        for word in words:
             heuristic_value = 0
-            for variable in self.csp.variables:
-                # Check if variable in domains matches with variable existed in variables. If not, get the the intersection between them
-                if variable != var:
-                    intersected_index = self.csp.intersects[var, variable]
-                    if variable not in assignment and intersected_index != None:
-                        # If such intersection and variable is not in assignment, check if these two words are the same. If it is, lower its priority
-                        for word2 in self.domains[variable]:
-                            if len(word1) > intersected_index[0] and len(word2) > intersected_index[1]:
-                                if word1[intersected_index[0]] != word2[intersected_index[1]]:
-                                    heuristic_value += 1
-                            else:
-                                break
-            result[word1] = heuristic_value
+            for i, size, counts in ruled_out:
+                heuristic_value += size - counts.get(word[i], 0)
+            result[word] = heuristic_value
         return sorted(result, key=result.get)
 
     def display_grid(self, height, width, assignment):
@@ -141,25 +285,129 @@ class CSP():
 
     def backtracking_search(self, assignment=None):
         assignment = {} if assignment is None else assignment
-        global RECURSIVE_CALLS
-        if len(assignment) == len(self.csp.variables):
-            sys.stdout.write(f'SUCCESS! Solution found after {RECURSIVE_CALLS} recursive calls to search\n')
+        self.track_unassigned(assignment)
+        return self._backtrack(assignment)
+
+    def _backtrack(self, assignment):
+        if not self.unassigned:
             return assignment
-            
+
         var = self.select_unassigned_variable(assignment)
         domain = self.order_domain_values(var, assignment)
 
-        solution = None  
+        refuted = []
         for word in domain:
-            assignment[var] = word
-            if self.is_consistent(assignment):
-                RECURSIVE_CALLS += 1
-                solution = self.backtracking_search(assignment)
+            if not self.is_consistent(var, word, assignment):
+                continue
+            mark = len(self.trail)
+            self.decisions.append((var, word, refuted))
+            if self.assign(var, word, assignment):
+                self.recursive_calls += 1
+                solution = self._backtrack(assignment)
+                if solution is not None:
+                    return solution
+            self.decisions.pop()
+            self.unassign(var, assignment, mark)
+            refuted.append(word)
+
+            self.failures += 1
+            if self.fail_limit is not None and self.failures > self.fail_limit:
+                raise SearchLimitReached()
+
+        return None
+
+    def _solutions(self, assignment):
+        if not self.unassigned:
+            yield assignment
+            return
 
-            if solution is not None:
-                break
-        
-        return solution
+        var = self.select_unassigned_variable(assignment)
+        for word in self.order_domain_values(var, assignment):
+            if not self.is_consistent(var, word, assignment):
+                continue
+            mark = len(self.trail)
+            if self.assign(var, word, assignment):
+                self.recursive_calls += 1
+                yield from self._solutions(assignment)
+            self.unassign(var, assignment, mark)
+
+    def iter_solutions(self, limit=None, copy=True):
+        '''
+        Yield every solution, lazily, as the search reaches it, stopping after limit solutions if given.
+        Words are all different within a solution, as is_consistent requires, and the search never
+        revisits a branch, so no filling is produced twice. With copy=False the live assignment is yielded
+        and is only valid until the generator resumes. Domains are restored when the generator finishes
+        or is closed.
+        '''
+        assignment = {}
+        self.track_unassigned(assignment)
+        mark = len(self.trail)
+        try:
+            for solution in islice(self._solutions(assignment), limit):
+                yield dict(solution) if copy else solution
+        finally:
+            for var, word in assignment.items():
+                self.used_words.discard(word)
+                self.unassigned.add(var.id)
+            self.undo(mark)
+
+    def count_solutions(self, limit=None):
+        '''
+        Count solutions, up to limit, without copying any assignment
+        '''
+        count = 0
+        for _ in self.iter_solutions(limit, copy=False):
+            count += 1
+        return count
+
+    def statistics(self):
+        return {
+            'recursive_calls': self.recursive_calls,
+            'consistency_checks': self.consistency_checks,
+            'prunings': self.prunings,
+            'restarts': self.restarts
+        }
+
+    def record_nogoods(self):
+        '''
+        Turn the current search path into nogoods before a restart: a word refuted at some level cannot be
+        combined with the decisions above that level, so each becomes a nogood over those (variable, word)
+        pairs. A word refuted at the top level is ruled out for good.
+        '''
+        prefix = []
+        for var, word, refuted in self.decisions:
+            for other in refuted:
+                nogood = tuple(prefix) + ((var.id, other),)
+                for literal in nogood:
+                    self.nogoods.setdefault(literal, []).append(nogood)
+            prefix.append((var.id, word))
+
+    def restart_search(self, schedule='luby', scale=32, growth=1.5):
+        '''
+        Randomized search with restarts. Each run gives up after a number of failed words that follows
+        the Luby sequence (or grows geometrically) times scale. Constraint weights and nogoods carry
+        over to the next run, so together with dom/wdeg ordering the search avoids repeating conflicts.
+        The limits grow without bound, so the search stays complete and None means no solution exists.
+        '''
+        self.randomize = True
+        mark = len(self.trail)
+        initial_domains = self.snapshot()
+        run = 0
+        while True:
+            run += 1
+            self.fail_limit = scale * luby(run) if schedule == 'luby' else int(scale * growth ** (run - 1))
+            self.failures = 0
+            try:
+                solution = self.backtracking_search({})
+                self.fail_limit = None
+                return solution
+            except SearchLimitReached:
+                self.record_nogoods()
+                self.decisions.clear()
+                self.used_words.clear()
+                self.restore(initial_domains)
+                del self.trail[mark:]
+                self.restarts += 1
 
 
 class GridCoordinate():
@@ -172,6 +420,8 @@ class GridCoordinate():
         self.column = column
         self.curr_move = curr_move
         self.length = length
+        # Position in CrosswordGrid.variables, set once all variables are known
+        self.id = None
         self.grid = []
         for k in range(self.length):
             self.grid.append(
@@ -196,10 +446,60 @@ def parse_words_data(file_name):
             words.append(line.rstrip())
         return set(words)
 
-class CrosswordGrid():
+class WordIndex():
+
+    def __init__(self, words):
+        '''
+        Give every dictionary word an integer ID and keep, for each word length and for each
+        (length, position, letter), a bitset of matching IDs stored as a Python int. Domains can then be
+        filtered, intersected and counted with bitwise AND and popcount.
+        '''
+        self.words = sorted(words)
+        self.ids = {word: k for k, word in enumerate(self.words)}
+
+        lengths = {}
+        positions = {}
+        for k, word in enumerate(self.words):
+            lengths.setdefault(len(word), []).append(k)
+            for position, letter in enumerate(word):
+                positions.setdefault((len(word), position), {}).setdefault(letter, []).append(k)
+
+        self.lengths = {length: self.from_ids(ids) for length, ids in lengths.items()}
+        self.positions = {
+            key: {letter: self.from_ids(ids) for letter, ids in letters.items()}
+            for key, letters in positions.items()
+        }
+
+    def from_ids(self, ids):
+        bits = bytearray((len(self.words) + 7) // 8)
+        for k in ids:
+            bits[k >> 3] |= 1 << (k & 7)
+        return int.from_bytes(bits, 'little')
+
+    def mask(self, words):
+        ids = self.ids
+        return self.from_ids(ids[word] for word in words)
+
+    def words_in(self, mask):
+        words = self.words
+        found = []
+        for byte_index, byte in enumerate(mask.to_bytes((len(words) + 7) // 8, 'little')):
+            while byte:
+                low = byte & -byte
+                found.append(words[(byte_index << 3) + low.bit_length() - 1])
+                byte ^= low
+        return found
+
+    def of_length(self, length):
+        return self.lengths.get(length, 0)
+
+    def letters_at(self, length, position):
+        return self.positions.get((length, position), {})
+
+    def matching(self, length, position, letter):
+        return self.letters_at(length, position).get(letter, 0)
 
-    GRID_HEIGHT = 0
-    GRID_WIDTH = 0
+class CrosswordGrid():
 
     def __init__(self, grid, words):
         '''
@@ -208,34 +508,40 @@ class CrosswordGrid():
         self.grid = grid
         self.words = words
         self.domain = []
-        self.variables = set()
+        self.variables = []
         self.intersects = dict()
+        self.neighbors = []
+        self.degree = []
 
-        global GRID_HEIGHT, GRID_WIDTH
-        GRID_HEIGHT = len(grid)
-        GRID_WIDTH = len(grid[0])
+        self.height = len(grid)
+        self.width = len(grid[0])
 
     def construct_overlapping_words(self):
-        for first_word in self.variables:
-            for second_word in self.variables:
-                if first_word == second_word:
-                    continue
-                cells1 = first_word.grid
-                cells2 = second_word.grid
-                intersection = set(cells1).intersection(cells2)
-                if not intersection:
-                    self.intersects[first_word, second_word] = None
-                else:
-                    intersection = intersection.pop()
-                    self.intersects[first_word, second_word] = (
-                        cells1.index(intersection),
-                        cells2.index(intersection)
-                    )
+        '''
+        Build the constraint graph in one pass over the cells: every cell covered by two variables links
+        them. intersects maps each linked ordered pair to its overlap indices, neighbors[id] lists
+        (variable, i, j) for a variable and degree[id] is its number of neighbors.
+        '''
+        cells = {}
+        for variable in self.variables:
+            for position, cell in enumerate(variable.grid):
+                cells.setdefault(cell, []).append((variable, position))
+
+        self.intersects = dict()
+        self.neighbors = [[] for _ in self.variables]
+        for sharing in cells.values():
+            if len(sharing) == 2:
+                (first_word, i), (second_word, j) = sharing
+                self.intersects[first_word, second_word] = (i, j)
+                self.intersects[second_word, first_word] = (j, i)
+                self.neighbors[first_word.id].append((second_word, i, j))
+                self.neighbors[second_word.id].append((first_word, j, i))
+        self.degree = [len(neighbors) for neighbors in self.neighbors]
         return self.intersects
 
     def construct_all_variables(self):
-        for i in range(GRID_HEIGHT):
-            for j in range(GRID_WIDTH):
+        for i in range(self.height):
+            for j in range(self.width):
                 # Check all words in vertical direction
                 vertical_word = (
                     self.domain[i][j] and (i == 0 or not self.domain[i - 1][j])
@@ -243,13 +549,13 @@ class CrosswordGrid():
 
                 if vertical_word:
                     max_vertical_length = 1
-                    for k in range(i + 1, GRID_HEIGHT):
+                    for k in range(i + 1, self.height):
                         if self.domain[k][j]:
                             max_vertical_length += 1
                         else:
                             break
                     if max_vertical_length > 1:
-                        self.variables.add(
+                        self.variables.append(
                             GridCoordinate(
                                 row=i, column=j,
                                 curr_move=GridCoordinate.MOVE_DOWN,
@@ -263,23 +569,25 @@ class CrosswordGrid():
                 )
                 if across_word:
                     max_across_length = 1
-                    for k in range(j + 1, GRID_WIDTH):
+                    for k in range(j + 1, self.width):
                         if self.domain[i][k]:
                             max_across_length += 1
                         else:
                             break
                     if max_across_length > 1:
-                        self.variables.add(GridCoordinate(
+                        self.variables.append(GridCoordinate(
                             row=i, column=j,
                             curr_move=GridCoordinate.MOVE_ACROSS,
                             length=max_across_length
                         ))
+        for var_id, variable in enumerate(self.variables):
+            variable.id = var_id
         return self.variables
 
     def construct_domains(self, grid):
-        for i in range(GRID_HEIGHT):
+        for i in range(self.height):
             row = []
-            for j in range(GRID_WIDTH):
+            for j in range(self.width):
                 if j >= len(grid[i]):
                     row.append(False)
                 elif grid[i][j] != "X":
@@ -290,11 +598,128 @@ class CrosswordGrid():
         return self.domain
 
     def get_neighbors(self, var):
-        all_neighbors = set()
-        for variable in self.variables:
-            if var != variable and self.intersects[var, variable]:
-                all_neighbors.add(variable)
-        return all_neighbors
+        return [variable for variable, _, _ in self.neighbors[var.id]]
+
+def build_crossword(grid_data, words):
+    cross_word = CrosswordGrid(grid_data, words)
+    cross_word.domain = cross_word.construct_domains(grid_data)
+    cross_word.variables = cross_word.construct_all_variables()
+    cross_word.intersects = cross_word.construct_overlapping_words()
+    return cross_word
+
+def portfolio_configurations(count):
+    '''
+    Solver configurations for a portfolio run: the default solver first, then variations in
+    preprocessing, inference and value ordering, then randomized tie-breaking with fresh seeds
+    '''
+    configurations = [
+        {'pre_processing': True, 'inference': 'mac', 'value_order': 'lcv', 'seed': None},
+        {'pre_processing': False, 'inference': 'mac', 'value_order': 'lcv', 'seed': None},
+        {'pre_processing': True, 'inference': 'forward', 'value_order': 'lcv', 'seed': None},
+        {'pre_processing': True, 'inference': 'mac', 'value_order': 'alphabetical', 'seed': None},
+        {'pre_processing': True, 'inference': 'mac', 'value_order': 'lcv', 'seed': 0,
+         'variable_order': 'domwdeg', 'restarts': 'luby'},
+    ]
+    seed = 0
+    while len(configurations) < count:
+        value_order = 'lcv' if seed % 2 == 0 else 'random'
+        configurations.append(
+            {'pre_processing': True, 'inference': 'mac', 'value_order': value_order, 'seed': seed})
+        seed += 1
+    return configurations[:count]
+
+def describe_configuration(configuration):
+    return ', '.join(f'{key}={value}' for key, value in configuration.items())
+
+def solve_crossword(grid_data, words, index, pre_processing=True, inference='mac', value_order='lcv',
+                    seed=None, variable_order='mrv', restarts=None):
+    '''
+    Solve one grid with its own CSP object, so calls can run side by side in threads or worker processes
+    sharing one read-only WordIndex. Returns the CSP, whose counters describe the search, and the
+    solution or None.
+    '''
+    csp = CSP(build_crossword(grid_data, words), index, inference, value_order, seed, variable_order)
+    solution = None
+    if not pre_processing or csp.arc_consistency_ac3():
+        if restarts:
+            solution = csp.restart_search(restarts)
+        else:
+            solution = csp.backtracking_search()
+    return csp, solution
+
+def solution_by_id(solution):
+    # Variables do not survive the trip between processes, so solutions travel as words by variable ID
+    return None if solution is None else {var.id: word for var, word in solution.items()}
+
+_worker_grid = None
+_worker_words = None
+_worker_index = None
+_worker_dictionary_file = None
+
+def _load_worker_dictionary(dictionary_file, words=None, index=None):
+    # Pool initializer: each worker process keeps its own dictionary and index, loading them if not handed over
+    global _worker_words, _worker_index, _worker_dictionary_file
+    if words is not None and index is not None:
+        _worker_words, _worker_index, _worker_dictionary_file = words, index, dictionary_file
+    elif _worker_dictionary_file != dictionary_file:
+        _worker_words = parse_words_data(dictionary_file)
+        _worker_index = WordIndex(_worker_words)
+        _worker_dictionary_file = dictionary_file
+
+def _init_portfolio_worker(grid_file, dictionary_file):
+    # Every worker parses the puzzle and indexes the dictionary once, then runs many configurations
+    global _worker_grid
+    _worker_grid = parse_grid_info(grid_file)
+    _load_worker_dictionary(dictionary_file)
+
+def _portfolio_worker(configuration):
+    start = time.perf_counter()
+    csp, solution = solve_crossword(_worker_grid, _worker_words, _worker_index, **configuration)
+    return configuration, solution_by_id(solution), csp.recursive_calls, time.perf_counter() - start
+
+def solve_portfolio(grid_file, dictionary_file, workers=None, configurations=None):
+    '''
+    Race several solver configurations over a process pool. Every configuration searches exhaustively,
+    so the first one to finish settles the puzzle either way; the pool is then terminated, cancelling
+    the others. Returns (configuration, {variable ID: word} or None, recursive calls, seconds).
+    '''
+    workers = workers or os.cpu_count() or 1
+    if configurations is None:
+        configurations = portfolio_configurations(max(workers, 4))
+    with multiprocessing.Pool(workers, initializer=_init_portfolio_worker,
+                              initargs=(grid_file, dictionary_file)) as pool:
+        for result in pool.imap_unordered(_portfolio_worker, configurations):
+            return result
+
+def solve_grid_file(grid_file, words, index, **options):
+    start = time.perf_counter()
+    csp, solution = solve_crossword(parse_grid_info(grid_file), words, index, **options)
+    return grid_file, solution_by_id(solution), csp.statistics(), time.perf_counter() - start
+
+def _grid_worker(task):
+    grid_file, options = task
+    return solve_grid_file(grid_file, _worker_words, _worker_index, **options)
+
+def solve_grids(grid_files, dictionary_file, workers=None, words=None, index=None, **options):
+    '''
+    Solve many grids against one dictionary over a process pool, yielding
+    (grid file, {variable ID: word} or None, search statistics, seconds) as each grid finishes.
+    The dictionary is indexed once here (or words and index are passed in) and handed to the pool
+    initializer, so forked workers share it. Nothing is kept in module state in this process, so
+    calls from several threads do not interfere.
+    '''
+    if words is None or index is None:
+        words = parse_words_data(dictionary_file)
+        index = WordIndex(words)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        for grid_file in grid_files:
+            yield solve_grid_file(grid_file, words, index, **options)
+        return
+    tasks = [(grid_file, options) for grid_file in grid_files]
+    with multiprocessing.Pool(workers, initializer=_load_worker_dictionary,
+                              initargs=(dictionary_file, words, index)) as pool:
+        yield from pool.imap_unordered(_grid_worker, tasks)
 
 def count_number_of_variables(grid):
     MAX_VARIABLES = 0
@@ -307,15 +732,41 @@ def count_number_of_variables(grid):
                     MAX_VARIABLES = int(grid[row][col]) + 1
     return MAX_VARIABLES
 
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Fill a crossword grid with words from a dictionary.')
+    parser.add_argument('grid_file')
+    parser.add_argument('dictionary_file')
+    parser.add_argument('pre_processing', nargs='?', default=None,
+                        help="run AC-3 before searching when 'true', '1' or 'bananagram'")
+    parser.add_argument('inference', nargs='?', default='mac', choices=['mac', 'forward'],
+                        help='propagation after each assignment (default: mac)')
+    parser.add_argument('--value-order', default='lcv', choices=CSP.VALUE_ORDERS,
+                        help='order in which the words of a variable are tried (default: lcv)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='break ties between variables and words at random with this seed')
+    parser.add_argument('--variable-order', default='mrv', choices=CSP.VARIABLE_ORDERS,
+                        help='mrv with degree tie-breaking, or dom/wdeg weighted by past conflicts (default: mrv)')
+    parser.add_argument('--restarts', choices=['luby', 'geometric'], default=None,
+                        help='randomized search that restarts on a growing failure limit, keeping nogoods')
+    parser.add_argument('--all', action='store_true',
+                        help='print every solution instead of the first one')
+    parser.add_argument('--count', action='store_true',
+                        help='only count the solutions')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='stop after this many solutions with --all or --count')
+    parser.add_argument('--grids', nargs='+', metavar='GRID',
+                        help='more grids to solve with the same dictionary, in parallel over --workers processes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes used for --grids (default: all cores)')
+    parser.add_argument('--portfolio', type=int, nargs='?', const=0, default=None, metavar='WORKERS',
+                        help='race several solver configurations in a process pool (default: all cores)')
+    return parser.parse_args(argv)
+
 def main():
-    pre_processing = None
-    if len(sys.argv) > 3:
-        grid_file = sys.argv[1]
-        dictionary_file = sys.argv[2]
-        pre_processing = sys.argv[3]
-    else:
-        grid_file = sys.argv[1]
-        dictionary_file = sys.argv[2]
+    args = parse_arguments()
+    grid_file = args.grid_file
+    dictionary_file = args.dictionary_file
+    pre_processing = args.pre_processing
 
     # Parse grid file into a 2D array
     grid_data = parse_grid_info(grid_file)
@@ -324,20 +775,39 @@ def main():
 
     # Parse words in dictionary file and store in a set
     words = parse_words_data(dictionary_file)
+    index = WordIndex(words)
+
+    if args.grids:
+        options = {
+            'pre_processing': pre_processing in ['true', '1', 'bananagram'],
+            'inference': args.inference,
+            'value_order': args.value_order,
+            'seed': args.seed,
+            'variable_order': args.variable_order,
+            'restarts': args.restarts
+        }
+        results = solve_grids([grid_file] + args.grids, dictionary_file, args.workers, words, index, **options)
+        for solved_file, solution, statistics, seconds in results:
+            if solution is None:
+                sys.stdout.write(f'{solved_file}: No solution found! ({seconds:.3f}s)\n')
+                continue
+            sys.stdout.write(f"{solved_file}: SUCCESS! Solution found after {statistics['recursive_calls']} "
+                             f"recursive calls to search ({seconds:.3f}s)\n")
+            solved_grid = parse_grid_info(solved_file)
+            cross_word = build_crossword(solved_grid, words)
+            assignment = {cross_word.variables[var_id]: word for var_id, word in solution.items()}
+            CSP(cross_word, index).display_grid(len(solved_grid), len(solved_grid[0]), assignment)
+        return
 
     variable_num = count_number_of_variables(grid_data)
     sys.stdout.write(f'Current number of variables: {variable_num}\n')
-    
-    cross_word = CrosswordGrid(grid_data, words)
-    cross_word.domain = cross_word.construct_domains(grid_data)
-    cross_word.variables = cross_word.construct_all_variables()
-    cross_word.intersects = cross_word.construct_overlapping_words()
 
-    csp = CSP(cross_word)
+    cross_word = build_crossword(grid_data, words)
+    csp = CSP(cross_word, index, args.inference, args.value_order, args.seed, args.variable_order)
 
     if pre_processing and pre_processing in ['true', '1', 'bananagram']:
         csp.arc_consistency_ac3()
-    
+
     sys.stdout.write('Initial assignment and domain size: \n')
     curr_index = 1
     map_direction = {
@@ -347,10 +817,39 @@ def main():
     for variable in cross_word.variables:
         sys.stdout.write(f'{curr_index}-{map_direction[variable.curr_move]} = NO VALUES ({variable_num} possible values)\n')
         curr_index += 1
-    solution = csp.backtracking_search()
+
+    if args.count:
+        count = csp.count_solutions(args.limit)
+        sys.stdout.write(f'Found {count} solutions after {csp.recursive_calls} recursive calls to search\n')
+        return
+    if args.all:
+        count = 0
+        for solution in csp.iter_solutions(args.limit, copy=False):
+            count += 1
+            sys.stdout.write(f'Solution {count} after {csp.recursive_calls} recursive calls to search\n')
+            csp.display_grid(height, width, solution)
+        sys.stdout.write(f'Found {count} solutions\n')
+        return
+
+    if args.portfolio is not None:
+        configuration, solution, recursive_calls, seconds = solve_portfolio(
+            grid_file, dictionary_file, workers=args.portfolio or None)
+        sys.stdout.write(f'Portfolio winner ({seconds:.3f}s): {describe_configuration(configuration)}\n')
+        if solution is not None:
+            solution = {cross_word.variables[var_id]: word for var_id, word in solution.items()}
+    elif args.restarts:
+        solution = csp.restart_search(args.restarts)
+        recursive_calls = csp.recursive_calls
+        sys.stdout.write(f'Restarts: {csp.restarts}\n')
+    else:
+        solution = csp.backtracking_search()
+        recursive_calls = csp.recursive_calls
 
     if solution:
+        sys.stdout.write(f'SUCCESS! Solution found after {recursive_calls} recursive calls to search\n')
         csp.display_grid(height, width, solution)
     else:
         sys.stdout.write("No solution found!\n")
-main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import argparse
+import platform
+import tracemalloc
+import random
+import json
+import glob
+import time
+import sys
+import os
+
+from app import CSP, WordIndex, SearchLimitReached, build_crossword, parse_grid_info, parse_words_data
+
+INPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inputData')
+DICTIONARIES = ('small', 'medium', 'large')
+
+def place_words(size, words, seed=0, fill=0.5, min_length=3, attempts=None):
+    '''
+    Lay dictionary words into a size x size board, crossword style: every new word crosses one already
+    placed, and no letter touches another except where two words cross, so each run of letters in the
+    board is exactly one placed word. Stops once fill of the cells hold letters. Returns {(row, column):
+    letter} and the placed words.
+    '''
+    generator = random.Random(seed)
+    candidates = sorted(word for word in words if min_length <= len(word) <= size)
+    by_letter = {}
+    for word in candidates:
+        for position, letter in enumerate(word):
+            by_letter.setdefault((len(word), position, letter), []).append(word)
+    steps = {'across': (0, 1), 'down': (1, 0)}
+
+    letters = {}
+    directions = {}
+    placed = set()
+
+    def fits(word, row, column, direction):
+        row_step, column_step = steps[direction]
+        end_row, end_column = row + row_step * (len(word) - 1), column + column_step * (len(word) - 1)
+        if word in placed or not (0 <= row and 0 <= column and end_row < size and end_column < size):
+            return False
+        if (row - row_step, column - column_step) in letters or (end_row + row_step, end_column + column_step) in letters:
+            return False
+        for position, letter in enumerate(word):
+            cell = (row + row_step * position, column + column_step * position)
+            if cell in letters:
+                if letters[cell] != letter or direction in directions[cell]:
+                    return False
+            elif (cell[0] + column_step, cell[1] + row_step) in letters or \
+                    (cell[0] - column_step, cell[1] - row_step) in letters:
+                return False
+        return True
+
+    def place(word, row, column, direction):
+        row_step, column_step = steps[direction]
+        for position, letter in enumerate(word):
+            cell = (row + row_step * position, column + column_step * position)
+            letters[cell] = letter
+            directions.setdefault(cell, set()).add(direction)
+        placed.add(word)
+
+    first = generator.choice(candidates)
+    place(first, generator.randrange(size), generator.randrange(size - len(first) + 1), 'across')
+    for _ in range(attempts or 400 * size):
+        if len(letters) >= fill * size * size:
+            break
+        row, column = generator.choice(sorted(letters))
+        direction = 'down' if 'across' in directions[row, column] else 'across'
+        row_step, column_step = steps[direction]
+        length = generator.randint(min_length, size)
+        position = generator.randrange(length)
+        options = by_letter.get((length, position, letters[row, column]))
+        if not options:
+            continue
+        word = generator.choice(options)
+        start_row, start_column = row - row_step * position, column - column_step * position
+        if fits(word, start_row, start_column, direction):
+            place(word, start_row, start_column, direction)
+    return letters, placed
+
+def generate_grid(size, words, seed=0, fill=0.5, min_length=3):
+    '''
+    Square grid in the parsed xword format, built around words placed from words so that it is known
+    to have a fill. Cells without a letter are blocks ('X') and every cell that starts a word is numbered.
+    '''
+    letters, _ = place_words(size, words, seed, fill, min_length)
+    grid = []
+    number = 0
+    for row in range(size):
+        cells = []
+        for column in range(size):
+            if (row, column) not in letters:
+                cells.append('X')
+                continue
+            starts_across = (row, column - 1) not in letters and (row, column + 1) in letters
+            starts_down = (row - 1, column) not in letters and (row + 1, column) in letters
+            if starts_across or starts_down:
+                number += 1
+                cells.append(str(number))
+            else:
+                cells.append('_')
+        grid.append(cells)
+    return grid
+
+def synthetic_dictionary(source_words, count, seed=0):
+    '''
+    count words drawn from a letter bigram model of source_words, with the same length distribution,
+    so the dictionary fills grids like real words do at any size
+    '''
+    generator = random.Random(seed)
+    transitions = {}
+    source_words = sorted(source_words)
+    for word in source_words:
+        previous = ''
+        for letter in word:
+            transitions.setdefault(previous, []).append(letter)
+            previous = letter
+    lengths = [len(word) for word in source_words]
+
+    words = set()
+    while len(words) < count:
+        letters = []
+        previous = ''
+        for _ in range(generator.choice(lengths)):
+            previous = generator.choice(transitions.get(previous) or transitions[''])
+            letters.append(previous)
+        words.add(''.join(letters))
+    return words
+
+def benchmark_cases(generated_sizes, synthetic_sizes):
+    '''
+    Yield (grid name, grid data, dictionary name, words, generated) for every input grid against every
+    dictionary, then generated grids against the large dictionary, then grids against synthetic
+    dictionaries. Generated grids are always built from the words of the dictionary they are run
+    against, so each has a known fill.
+    '''
+    dictionaries = {name: parse_words_data(os.path.join(INPUT_DIR, f'dictionary_{name}.txt')) for name in DICTIONARIES}
+    grids = {
+        os.path.basename(grid_file): parse_grid_info(grid_file)
+        for grid_file in sorted(glob.glob(os.path.join(INPUT_DIR, 'xword*.txt')))
+    }
+    for grid_name, grid_data in grids.items():
+        for dictionary_name, words in dictionaries.items():
+            yield grid_name, grid_data, dictionary_name, words, False
+
+    for size in generated_sizes:
+        yield f'generated{size}x{size}', generate_grid(size, dictionaries['large'], seed=size), 'large', \
+            dictionaries['large'], True
+
+    for count in synthetic_sizes:
+        words = synthetic_dictionary(dictionaries['large'], count, seed=count)
+        for grid_name, grid_data in grids.items():
+            yield grid_name, grid_data, f'synthetic{count}', words, False
+        for size in generated_sizes:
+            yield f'generated{size}x{size}', generate_grid(size, words, seed=size), f'synthetic{count}', words, True
+
+def run_solver(grid_data, words, index, pre_processing, inference='mac', max_failures=None, trace_memory=False):
+    '''
+    Solve one grid from scratch and return its counters. The search gives up after max_failures
+    refuted words, so a hard case cannot stall the whole suite.
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    csp = CSP(build_crossword(grid_data, words), index, inference)
+    csp.fail_limit = max_failures
+    try:
+        if pre_processing and not csp.arc_consistency_ac3():
+            status = 'no solution'
+        else:
+            status = 'solved' if csp.backtracking_search() is not None else 'no solution'
+    except SearchLimitReached:
+        status = 'gave up'
+    seconds = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'variables': len(csp.csp.variables),
+        'status': status,
+        'seconds': seconds,
+        'recursive_calls': csp.recursive_calls,
+        'consistency_checks': csp.consistency_checks,
+        'prunings': csp.prunings,
+        'peak_memory_kb': None if peak_memory is None else peak_memory / 1024
+    }
+
+def run_benchmarks(generated_sizes=(9, 13, 17), synthetic_sizes=(5000,), max_failures=100, memory=True,
+                   verbose=True):
+    '''
+    Run every case with and without AC-3 preprocessing. Wall time comes from an untraced run; peak
+    memory from a second run under tracemalloc, since tracing slows the search down. Runs on generated
+    grids are marked, as those grids are known to have a fill: 'no solution' there is a solver bug.
+    '''
+    runs = []
+    indexes = {}
+    for grid_name, grid_data, dictionary_name, words, generated in benchmark_cases(generated_sizes, synthetic_sizes):
+        if dictionary_name not in indexes:
+            index_start = time.perf_counter()
+            indexes[dictionary_name] = (WordIndex(words), len(words), time.perf_counter() - index_start)
+        index = indexes[dictionary_name][0]
+        for pre_processing in (False, True):
+            run = {'grid': grid_name, 'dictionary': dictionary_name, 'pre_processing': pre_processing,
+                   'generated': generated}
+            run.update(run_solver(grid_data, words, index, pre_processing, max_failures=max_failures))
+            if memory:
+                traced = run_solver(grid_data, words, index, pre_processing, max_failures=max_failures, trace_memory=True)
+                run['peak_memory_kb'] = traced['peak_memory_kb']
+            if verbose:
+                sys.stderr.write(f"{grid_name:>18} {dictionary_name:>16} {'ac3' if pre_processing else '   '} "
+                                 f"{run['status']:>12} {run['seconds']:8.3f}s {run['recursive_calls']:>7} calls\n")
+            runs.append(run)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'max_failures': max_failures,
+        'dictionaries': {
+            name: {'words': count, 'index_seconds': seconds} for name, (_, count, seconds) in indexes.items()
+        },
+        'runs': runs,
+        'total_seconds': sum(run['seconds'] for run in runs)
+    }
+
+def compare_reports(baseline, report, stream=sys.stdout):
+    '''
+    Print the time and recursive calls of every run next to the same run in a baseline report. A run
+    that gave up at the failure limit has no meaningful time, so it is reported without a ratio
+    '''
+    def key(run):
+        return run['grid'], run['dictionary'], run['pre_processing']
+
+    previous = {key(run): run for run in baseline['runs']}
+    for run in report['runs']:
+        old = previous.get(key(run))
+        if old is None:
+            continue
+        if 'gave up' in (old['status'], run['status']):
+            stream.write(f"{run['grid']:>18} {run['dictionary']:>16} {'ac3' if run['pre_processing'] else '   '} "
+                         f"{old['status']:>12} -> {run['status']}\n")
+            continue
+        ratio = run['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        stream.write(f"{run['grid']:>18} {run['dictionary']:>16} {'ac3' if run['pre_processing'] else '   '} "
+                     f"{old['seconds']:8.3f}s -> {run['seconds']:8.3f}s ({ratio:5.2f}x) "
+                     f"{old['recursive_calls']:>7} -> {run['recursive_calls']:>7} calls"
+                     f"{'' if old['status'] == run['status'] else ' ' + old['status'] + ' -> ' + run['status']}\n")
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the crossword solver across grids and dictionaries.')
+    parser.add_argument('--output', default='-', help='where the JSON report is written (default stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='earlier JSON report to compare against')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[9, 13, 17],
+                        help='sizes of the generated square grids')
+    parser.add_argument('--synthetic', type=int, nargs='*', default=[5000],
+                        help='word counts of the synthetic dictionaries')
+    parser.add_argument('--max-failures', type=int, default=100,
+                        help='refuted words after which a run gives up')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_arguments()
+    report = run_benchmarks(args.sizes, args.synthetic, args.max_failures, memory=not args.no_memory)
+    output_stream = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        json.dump(report, output_stream, indent=2)
+        output_stream.write('\n')
+    finally:
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare_reports(json.load(baseline_file), report, sys.stderr)
+
+if __name__ == '__main__':
+    main()